@@ -26,11 +26,15 @@ class ErrorCode(Enum):
     # 项目
     PROJECT_GROUP_HAS_PROJECT = 30000, '文件分组下存在文件，无法删除'
     PROJECT_NOT_HAVE_CASES = 30001, '当前项目没有可执行用例，已忽略执行'
+    BATCH_NOT_HAVE_PROJECTS = 30002, '没有需要执行的项目，请传入项目分组或者项目 id 列表'
 
     # 用例
     CASE_CREATE_REPORT_FAILED = 40000, '用例执行生成结果失败，请稍后再试'
     EXPECTED_NOT_ALLOWED = 40001, '预期字段和预期值个数不匹配'
     DEPEND_NOT_ALLOWED = 40002, '依赖参数和依赖取值个数不匹配'
+    CASE_DEPEND_CYCLE = 40003, '用例依赖存在循环，请检查用例: {}'
+    ASYNC_ENGINE_UNAVAILABLE = 40004, '异步执行引擎不可用，请先安装 aiohttp'
+    CASE_NAME_EXISTED = 40005, '项目下已存在名称为 {} 的用例'
 
     def __init__(self, code, message):
         self.code = code
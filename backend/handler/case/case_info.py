@@ -1,4 +1,3 @@
-import json
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.paginator import Paginator
 from django.db import transaction
@@ -7,9 +6,11 @@ from rest_framework.decorators import action
 from backend.exception import ErrorCode, PlatformError
 from backend.handler.contactor import contactor
 from backend.handler.project import project
-from backend.models import CaseInfo
-from backend.util import UserHolder, Response, parse_data, page_params, get_params, update_fields, Executor, save, \
-    batch_update
+from backend.handler.record import report
+from backend.models import CaseInfo, Contactor
+from backend.util import UserHolder, Response, parse_data, page_params, get_params, update_fields, Executor, \
+    batch_update, batch_save, validate, decode_fields, statistics
+from backend.settings import JSON_FIELDS, SNAPSHOT_FIELDS
 
 fields_cache = ['id', 'name', 'remark', 'method', 'host', 'path', 'params', 'extend_keys', 'extend_values',
                 'headers', 'expected_keys', 'expected_values', 'expected_http_status', 'check_status', 'run',
@@ -39,10 +40,11 @@ class CaseInfoViewSet(viewsets.ModelViewSet):
         case_info = CaseInfo(**body)
         project.get_by_id(case_info.project_id)
         case_info.sort = computedMaxSort(case_info.project_id) + 1
+        encoding(case_info)
         # 参数校验
         check_params(case_info)
-        encoding(case_info)
-        save(case_info)
+        save_case(case_info)
+        statistics.incr(statistics.CASE)
         return Response.success(case_info)
 
     def destroy(self, request, *args, **kwargs):
@@ -56,6 +58,8 @@ class CaseInfoViewSet(viewsets.ModelViewSet):
         id = kwargs['pk']
         case_info = get_by_id(id)
         case_info.delete()
+        release_snapshots([case_info.snapshot_hash])
+        statistics.incr(statistics.CASE, -1)
         return Response.def_success()
 
     def update(self, request, *args, **kwargs):
@@ -66,11 +70,13 @@ class CaseInfoViewSet(viewsets.ModelViewSet):
         data = parse_data(request, 'PUT')
         param_dict = get_params(data, *fields_cache)
         case_info = get_by_id(param_dict['id'])
+        old_hash = case_info.snapshot_hash
         update_fields(case_info, **param_dict)
+        encoding(case_info)
         # 参数校验
         check_params(case_info)
-        encoding(case_info)
-        save(case_info)
+        save_case(case_info)
+        release_snapshots([old_hash])
         return Response.success(case_info)
 
     def list(self, request, *args, **kwargs):
@@ -84,6 +90,7 @@ class CaseInfoViewSet(viewsets.ModelViewSet):
         可传入 method 精确匹配
         可传入 run 精确匹配
         可传入 developer 精确匹配
+        结果示例为压缩存储，列表中不查询，只在详情中返回
         """
 
         data = parse_data(request, 'GET')
@@ -94,20 +101,12 @@ class CaseInfoViewSet(viewsets.ModelViewSet):
             raise PlatformError.error_args(ErrorCode.MISSING_NECESSARY_KEY, 'project_id')
         pro = project.get_by_id(project_id)
         case_infos = CaseInfo.objects.owner().exact(project_id=project_id).contains(name=name, path=path).iexact(
-            method=method).exact(run=run, developer=developer)
+            method=method).exact(run=run, developer=developer).join_name(Contactor, 'developer', 'developer_name') \
+            .defer('sample')
         page_case_infos = Paginator(case_infos, page_size)
         result = page_case_infos.page(page)
-        # 得到所有开发者 id
-        developer_ids = [o.developer for o in result.object_list if o.developer]
-        developer_names = {}
-        developers = contactor.get_list_by_ids(developer_ids)
-        for developer in developers:
-            developer_names.update({developer.id: developer.name})
         for case_info in result.object_list:
-            if case_info.developer:
-                case_info.developer_name = developer_names[case_info.developer]
             case_info.project_name = pro.name
-            decoding(case_info)
         return Response.success(result)
 
     def retrieve(self, request, *args, **kwargs):
@@ -137,7 +136,8 @@ class CaseInfoViewSet(viewsets.ModelViewSet):
         new_case_info.id = None
         new_case_info.name = name
         new_case_info.sort = computedMaxSort(new_case_info.project_id) + 1
-        save(new_case_info)
+        save_case(new_case_info)
+        statistics.incr(statistics.CASE)
         return Response.success(new_case_info)
 
     @action(methods=['GET'], detail=False, url_path='export')
@@ -263,6 +263,17 @@ def check_params(case_info):
         contactor.get_by_id(case_info.developer)
     # 项目
     project.get_by_id(case_info.project_id)
+    check_format(case_info)
+
+
+def check_format(case_info):
+    """
+    对用例的参数格式进行校验，不查询数据库
+
+    校验预期字段和预期值列表是否匹配
+    校验注入字段和注入值列表是否匹配
+    """
+
     # 预期
     if (case_info.expected_keys is None and case_info.expected_values) or (
             case_info.expected_keys and case_info.expected_values is None) or (
@@ -305,7 +316,11 @@ def delete_by_project(project_id):
     根据项目批量删除
     """
 
-    CaseInfo.objects.owner().filter(project_id=project_id).delete()
+    case_infos = CaseInfo.objects.owner().filter(project_id=project_id)
+    hashes = list(case_infos.values_list('snapshot_hash', flat=True))
+    deleted, _ = case_infos.delete()
+    release_snapshots(hashes)
+    statistics.incr(statistics.CASE, -deleted)
 
 
 def count():
@@ -327,31 +342,21 @@ def list_by_project(project_id):
 def encoding(case_info):
     """
     对部分参数进行编码操作
+
+    注入、预期相关字段已经是 JSONField，不再需要编码，只将字符串形式的值解析为对象，避免存成 JSON 字符串
     """
 
-    if case_info.extend_keys:
-        case_info.extend_keys = json.dumps(case_info.extend_keys)
-    if case_info.extend_values:
-        case_info.extend_values = json.dumps(case_info.extend_values)
-    if case_info.expected_keys:
-        case_info.expected_keys = json.dumps(case_info.expected_keys)
-    if case_info.expected_values:
-        case_info.expected_values = json.dumps(case_info.expected_values)
+    decode_fields(case_info, *JSON_FIELDS)
 
 
 def decoding(case_info):
     """
     对部分参数进行解码操作
+
+    兼容旧的调用方式，只解析字符串形式的值
     """
 
-    if case_info.extend_keys:
-        case_info.extend_keys = json.loads(case_info.extend_keys)
-    if case_info.extend_values:
-        case_info.extend_values = json.loads(case_info.extend_values)
-    if case_info.expected_keys:
-        case_info.expected_keys = json.loads(case_info.expected_keys)
-    if case_info.expected_values:
-        case_info.expected_values = json.loads(case_info.expected_values)
+    decode_fields(case_info, *JSON_FIELDS)
 
 
 def computedMaxSort(project_id):
@@ -362,10 +367,144 @@ def computedMaxSort(project_id):
     return int(max_sort['sort']) if max_sort else 0
 
 
+def snapshot(case_infos):
+    """
+    计算用例快照的哈希并保存快照内容
+
+    快照在保存用例时根据未压缩的值计算一次，执行时报告直接引用哈希，不再每次执行都解压结果示例并重新计算
+    需要在写入用例的事务中调用
+    """
+
+    payloads = {}
+    for case_info in case_infos:
+        content = {field: getattr(case_info, field, None) for field in SNAPSHOT_FIELDS}
+        case_info.snapshot_hash = report.digest(content)
+        payloads[case_info.snapshot_hash] = content
+    report.save_payloads(payloads)
+
+
+@transaction.atomic
+def save_case(case_info):
+    """
+    保存用例以及用例快照
+    """
+
+    validate(case_info)
+    snapshot([case_info])
+    case_info.save()
+
+
+def release_snapshots(hashes):
+    """
+    用例修改或者删除后，清理不再被用例以及报告引用的快照
+
+    在事务提交后执行，清理时需要在独立的事务中加锁
+    """
+
+    hashes = {hash for hash in hashes if hash}
+    if hashes:
+        transaction.on_commit(lambda: report.delete_payloads(hashes))
+
+
+def fill_snapshots(case_infos):
+    """
+    为没有快照的用例(快照功能之前创建的用例)补充快照
+
+    执行时用例不查询结果示例，补充快照时只为缺少快照的用例查询一次
+    """
+
+    missing = [o for o in case_infos if not o.snapshot_hash]
+    if not missing:
+        return
+    with transaction.atomic():
+        samples = dict(CaseInfo.objects.filter(id__in=[o.id for o in missing]).values_list('id', 'sample'))
+        for case_info in missing:
+            case_info.sample = samples.get(case_info.id)
+        snapshot(missing)
+        batch_update(CaseInfo.objects, missing, ['snapshot_hash'])
+
+
 # -------------------------------------------- 临时 -----------------------------------------
 def create_case(case):
     case.sort = computedMaxSort(case.project_id) + 1
     # 参数校验
     check_params(case)
     encoding(case)
-    save(case)
+    save_case(case)
+    statistics.incr(statistics.CASE, owner=case.owner)
+
+
+@transaction.atomic
+def bulk_create_cases(cases):
+    """
+    批量创建用例
+
+    1. 开发者、项目各查询一次完成校验，参数格式在内存中校验
+    2. 用例名称在项目下唯一，批次内的重复在内存中检查，与已有用例的重复每个项目查询一次
+    3. 每个项目只计算一次最大排序，按顺序依次分配排序
+    4. 批量插入后一次查询得到 id，将依赖用例对象替换为 id 后批量更新注入值
+    5. 用例快照在注入值确定后计算，与用例一起写入
+    """
+
+    if not cases:
+        return
+    # 项目
+    project_ids = {case.project_id for case in cases}
+    existed_projects = {o.id for o in project.get_list_by_ids(project_ids)}
+    # 开发者
+    developer_ids = {case.developer for case in cases if case.developer}
+    existed_developers = {o.id for o in contactor.get_list_by_ids(developer_ids)} if developer_ids else set()
+    # 批次内的用例名称
+    names = set()
+    for case in cases:
+        key = (case.owner, case.project_id, case.name)
+        if key in names:
+            raise PlatformError.error_args(ErrorCode.CASE_NAME_EXISTED, case.name)
+        names.add(key)
+    # 每个项目的最大排序
+    sorts = {}
+    # 依赖尚未入库用例的注入值
+    pending = []
+    for case in cases:
+        if case.project_id not in existed_projects:
+            raise PlatformError.error_args(ErrorCode.DATA_NOT_EXISTED, '项目', 'id')
+        if case.developer and case.developer not in existed_developers:
+            raise PlatformError.error_args(ErrorCode.DATA_NOT_EXISTED, '联系人', 'id')
+        check_format(case)
+        if case.project_id not in sorts:
+            sorts[case.project_id] = computedMaxSort(case.project_id)
+        sorts[case.project_id] += 1
+        case.sort = sorts[case.project_id]
+        if case.extend_values and any(isinstance(value.get('depend'), CaseInfo) for value in case.extend_values):
+            pending.append((case, case.extend_values))
+            case.extend_values = None
+        encoding(case)
+        validate(case, validate_unique=False)
+    # 已有的用例名称
+    for project_id in project_ids:
+        existed = CaseInfo.objects.owner().filter(project_id=project_id, name__in=[
+            case.name for case in cases if case.project_id == project_id]).values_list('name', flat=True).first()
+        if existed is not None:
+            raise PlatformError.error_args(ErrorCode.CASE_NAME_EXISTED, existed)
+    # 依赖尚未入库用例的快照在注入值确定后计算
+    waiting = {id(case) for case, _ in pending}
+    snapshot([case for case in cases if id(case) not in waiting])
+    batch_save(CaseInfo.objects, cases)
+    for owner in {case.owner for case in cases}:
+        statistics.incr(statistics.CASE, len([case for case in cases if case.owner == owner]), owner=owner)
+    if not pending:
+        return
+    # 用例名称在项目下唯一，根据名称查回 id
+    for project_id in project_ids:
+        names = [case.name for case in cases if case.project_id == project_id]
+        ids = dict(CaseInfo.objects.owner().filter(project_id=project_id, name__in=names).values_list('name', 'id'))
+        for case in cases:
+            if case.project_id == project_id:
+                case.id = ids.get(case.name)
+    for case, extend_values in pending:
+        for value in extend_values:
+            if isinstance(value.get('depend'), CaseInfo):
+                value['depend'] = value['depend'].id
+        case.extend_values = extend_values
+    snapshot([case for case, _ in pending])
+    batch_update(CaseInfo.objects, [case for case, _ in pending], ['extend_values', 'snapshot_hash'])
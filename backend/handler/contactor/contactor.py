@@ -2,7 +2,7 @@ from django.core.exceptions import ObjectDoesNotExist
 from django.core.paginator import Paginator
 from rest_framework import serializers, viewsets
 from backend.exception import ErrorCode, PlatformError
-from backend.models import Contactor
+from backend.models import Contactor, ContactorGroup
 from backend.handler.contactor import contactor_group
 from backend.util import Response, parse_data, get_params, update_fields, page_params, save
 
@@ -75,19 +75,10 @@ class ContactorViewSet(viewsets.ModelViewSet):
 
         data = parse_data(request, 'GET')
         page, page_size, name, phone, email = page_params(data, 'name', 'phone', 'email').values()
-        contactors = Contactor.objects.owner().contains(name=name, phone=phone, email=email)
+        contactors = Contactor.objects.owner().contains(name=name, phone=phone, email=email) \
+            .join_name(ContactorGroup, 'group_id', 'group_name')
         page_contactors = Paginator(contactors, page_size)
         result = page_contactors.page(page)
-        # 得到所有分组 id
-        group_ids = [o.group_id for o in result.object_list]
-        group_names = {}
-        groups = contactor_group.get_list_by_ids(group_ids)
-        for group in groups:
-            group_names.update({group.id: group.name})
-        for contactor in result.object_list:
-            group_name = group_names[contactor.group_id]
-            if group_name:
-                contactor.group_name = group_name
         return Response.success(result)
 
     def retrieve(self, request, *args, **kwargs):
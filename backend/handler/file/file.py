@@ -8,7 +8,7 @@ from rest_framework import serializers, viewsets
 from rest_framework.decorators import action
 from backend import FILE_REPO
 from backend.exception import ErrorCode, ValidateError, PlatformError
-from backend.models import File
+from backend.models import File, FileGroup
 from backend.handler.file import file_group
 from backend.util import Response, parse_data, get_params, update_fields, page_params, save
 
@@ -79,19 +79,9 @@ class FileViewSet(viewsets.ModelViewSet):
 
         data = parse_data(request, 'GET')
         page, page_size, name = page_params(data, 'name').values()
-        files = File.objects.owner().contains(name=name)
+        files = File.objects.owner().contains(name=name).join_name(FileGroup, 'group_id', 'group_name')
         page_files = Paginator(files, page_size)
         result = page_files.page(page)
-        # 得到所有分组 id
-        group_ids = [o.group_id for o in result.object_list]
-        group_names = {}
-        groups = file_group.get_list_by_ids(group_ids)
-        for group in groups:
-            group_names.update({group.id: group.name})
-        for file in result.object_list:
-            group_name = group_names[file.group_id]
-            if group_name:
-                file.group_name = group_name
         return Response.success(result)
 
     def retrieve(self, request, *args, **kwargs):
@@ -0,0 +1 @@
+from backend.handler.metrics import metrics
\ No newline at end of file
@@ -0,0 +1,15 @@
+from django.http import HttpResponse
+from rest_framework import viewsets
+from backend.util.metrics import metrics
+
+
+class MetricsViewSet(viewsets.ViewSet):
+
+    def list(self, request):
+        """
+        以 Prometheus 文本格式输出当前进程的请求指标
+
+        需要登录，或者配置 METRICS_TOKEN 后使用 Authorization: Bearer <token> 抓取
+        """
+
+        return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,10 @@
+from django.urls import path, include
+from rest_framework import routers
+from backend.handler.metrics import metrics
+
+router = routers.DefaultRouter()
+router.register(r'metrics', metrics.MetricsViewSet, basename='metrics')
+urlpatterns = (
+    # 请求指标
+    path('', include(router.urls)),
+)
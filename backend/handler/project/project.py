@@ -1,9 +1,15 @@
 import json
+import multiprocessing
 import os
+import tempfile
 import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+import django
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.paginator import Paginator
+from django.db import transaction
 from django.http import FileResponse
 from rest_framework import serializers, viewsets
 from rest_framework.decorators import action
@@ -11,14 +17,17 @@ from rest_framework.decorators import action
 from backend.exception import ErrorCode, ValidateError, PlatformError
 from backend.handler.case import case_info
 from backend.handler.project import project_group
-from backend.handler.record import record
-from backend.models import Project, CaseInfo, Report
-from backend.settings import IGNORED, FAILED, PASSED
+from backend.handler.record import record, report
+from backend.models import Project, CaseInfo, ProjectGroup
+from backend.settings import RUNNING, FINISHED, ERROR, BATCH_WORKERS, BATCH_HOST_LIMIT, EXPORT_SPOOL_SIZE
 from backend.util import UserHolder, Response, parse_data, get_params, update_fields, page_params, Executor, save, \
     batch_save
-from backend.util.resp_data import obj_to_dict
-from testing_platform.settings import FILE_REPO
-from backend.util.temp_excel_handler import ExcelParser, CaseInfoHolder, build_extend, build_expected, ExcelWriter
+from backend.util import job, statistics
+from backend.util.job import Progress, ImportProgress, BatchProgress
+from backend.util.http_session import HostLimiter
+from testing_platform.settings import FILE_REPO, LOGGER
+from backend.util.temp_excel_handler import ExcelParser, CaseInfoHolder, build_extend, build_expected, ExcelWriter, \
+    parse_sheet
 
 
 class ProjectSerializer(serializers.ModelSerializer):
@@ -42,6 +51,7 @@ class ProjectViewSet(viewsets.ModelViewSet):
         # 校验分组是否存在
         project_group.get_by_id(project.group_id)
         save(project)
+        statistics.incr(statistics.PROJECT)
         return Response.success(project)
 
     def destroy(self, request, *args, **kwargs):
@@ -58,6 +68,7 @@ class ProjectViewSet(viewsets.ModelViewSet):
         id = kwargs['pk']
         project = get_by_id(id)
         project.delete()
+        statistics.incr(statistics.PROJECT, -1)
         case_info.delete_by_project(id)
         return Response.def_success()
 
@@ -86,19 +97,10 @@ class ProjectViewSet(viewsets.ModelViewSet):
 
         data = parse_data(request, 'GET')
         page, page_size, name, group_id = page_params(data, 'name', 'group_id').values()
-        projects = Project.objects.filter(owner=UserHolder.current_user()).exact(group_id=group_id).contains(name=name)
+        projects = Project.objects.filter(owner=UserHolder.current_user()).exact(group_id=group_id).contains(name=name) \
+            .join_name(ProjectGroup, 'group_id', 'group_name')
         page_projects = Paginator(projects, page_size)
         result = page_projects.page(page)
-        # 得到所有分组 id
-        group_ids = [o.group_id for o in result.object_list]
-        group_names = {}
-        groups = project_group.get_list_by_ids(group_ids)
-        for group in groups:
-            group_names.update({group.id: group.name})
-        for project in result.object_list:
-            group_name = group_names[project.group_id]
-            if group_name:
-                project.group_name = group_name
         return Response.success(result)
 
     def retrieve(self, request, *args, **kwargs):
@@ -128,6 +130,7 @@ class ProjectViewSet(viewsets.ModelViewSet):
         new_project.id = None
         new_project.name = name
         save(new_project)
+        statistics.incr(statistics.PROJECT)
         case_infos = case_info.list_by_project(old_project.id)
         new_infos = []
         for info in case_infos:
@@ -137,7 +140,10 @@ class ProjectViewSet(viewsets.ModelViewSet):
             new_case_info.project_id = new_project.id
             new_infos.append(new_case_info)
         if new_infos:
-            batch_save(CaseInfo.objects, new_infos)
+            with transaction.atomic():
+                case_info.snapshot(new_infos)
+                batch_save(CaseInfo.objects, new_infos)
+            statistics.incr(statistics.CASE, len(new_infos))
         return Response.success(new_project)
 
     @action(methods=['POST'], detail=False, url_path='execute')
@@ -145,40 +151,91 @@ class ProjectViewSet(viewsets.ModelViewSet):
         """
         执行项目下所有接口用例
 
-        1. 执行接口用例
-        2. 生成用例报告
+        1. 执行接口用例，默认按顺序逐个执行，传入 workers 时无依赖关系的用例并发执行
+           可传入 engine 指定执行引擎，thread 为线程池(默认)，async 为事件循环
+           可传入 pool_size 指定每个 host 的连接池大小
+        2. 生成用例报告，执行过程中分批写入，可传入 batch_size 指定批次大小
         """
 
         data = parse_data(request, 'POST')
-        params = get_params(data, 'id')
-        project = get_by_id(params['id'])
-        case_infos = case_info.list_by_project(project.id)
-        if not case_infos:
-            raise PlatformError.error(ErrorCode.PROJECT_NOT_HAVE_CASES)
-        executor = Executor(case_infos=case_infos, project=project)
-        reports = executor.execute()
-        # 构建记录
-        ignored_num = [obj for obj in reports if getattr(obj, 'status') == IGNORED]
-        passed_num = [obj for obj in reports if getattr(obj, 'status') == PASSED]
-        failed_num = [obj for obj in reports if getattr(obj, 'status') == FAILED]
-        reco = record.create(group_id=project.group_id, project_id=project.id, owner=project.owner,
-                             total=len(case_infos), ignored=len(ignored_num), passed=len(passed_num),
-                             failed=len(failed_num))
-        for result in reports:
-            result.record_id = reco.id
-            case_info.encoding(result)
-            result.owner = reco.owner
-        batch_save(Report.objects, [Report(**obj_to_dict(report)) for report in reports])
+        params = get_params(data, 'id', 'workers', 'engine', 'pool_size', 'batch_size')
+        project, case_infos, reco = prepare_execute(params['id'])
+        run_project(project, case_infos, reco, workers=params['workers'], engine=params['engine'],
+                    pool_size=params['pool_size'], batch_size=params['batch_size'])
         return Response.success(reco)
 
+    @action(methods=['POST'], detail=False, url_path='submit')
+    def submit(self, request):
+        """
+        后台执行项目下所有接口用例
+
+        参数与 execute 一致，立即返回测试记录，可通过记录的 progress 接口查询执行进度
+        """
+
+        data = parse_data(request, 'POST')
+        params = get_params(data, 'id', 'workers', 'engine', 'pool_size', 'batch_size')
+        project, case_infos, reco = prepare_execute(params['id'])
+        job.submit(reco.owner, run_project, project, case_infos, reco, workers=params['workers'],
+                   engine=params['engine'], pool_size=params['pool_size'], batch_size=params['batch_size'])
+        return Response.success(reco)
+
+    @action(methods=['POST'], detail=False, url_path='batch-execute')
+    def batch_execute(self, request):
+        """
+        批量执行多个项目
+
+        1. 传入 group_id 执行分组下所有项目，或者传入 ids 执行指定项目
+        2. 立即为每个项目创建测试记录并返回批次 id，项目在后台执行，
+           可通过 batch-progress 接口查询整个批次的汇总，或者通过记录的 progress 接口查询单个项目的执行进度
+        3. 项目在线程池中并发执行，可传入 workers 指定同时执行的项目数
+        4. 可传入 host_limit 限制对同一个 host 同时进行中的请求数
+        """
+
+        data = parse_data(request, 'POST')
+        params = get_params(data, 'group_id', 'ids', 'workers', 'host_limit', 'engine', 'batch_size')
+        projects = list_for_batch(params['group_id'], params['ids'])
+        if not projects:
+            raise PlatformError.error(ErrorCode.BATCH_NOT_HAVE_PROJECTS)
+        executions, skipped = prepare_batch(projects)
+        batch = BatchProgress(uuid.uuid4().hex, len(projects), [reco.id for _, _, reco in executions], skipped)
+        batch.flush()
+        if executions:
+            job.submit(UserHolder.current_user(), run_batch, executions, workers=params['workers'],
+                       host_limit=params['host_limit'], engine=params['engine'], batch_size=params['batch_size'])
+        return Response.success({
+            'id': batch.batch_id,
+            'projects': len(projects),
+            'skipped': skipped,
+            'records': [reco for _, _, reco in executions]
+        })
+
+    @action(methods=['GET'], detail=False, url_path='batch-progress')
+    def batch_progress(self, request):
+        """
+        查询批量执行的汇总
+
+        由批次中各个测试记录的执行进度汇总，所有记录结束后状态为结束，有记录执行失败时为失败
+        """
+
+        data = parse_data(request, 'GET')
+        params = get_params(data, 'id')
+        batch = BatchProgress.get(params['id'])
+        if batch is None:
+            raise PlatformError.error_args(ErrorCode.DATA_NOT_EXISTED, '批量执行', 'id')
+        progresses = [record.get_progress(o) for o in record.get_list_by_ids(batch['records'])]
+        return Response.success(summarize_batch(batch, progresses))
+
     @action(methods=['POST'], detail=False, url_path='temp-import')
     def imported(self, request):
         """
         旧版 Excel 的导入
+
+        传入 processes 时在后台以多进程并行解析各个 sheet 页，立即返回导入任务 id，
+        可通过 temp-import-progress 接口查询导入进度
         """
 
         data = parse_data(request, 'POST')
-        params = get_params(data, 'project_id')
+        params = get_params(data, 'project_id', 'processes')
         project = get_by_id(params['project_id'])
         files = request.FILES.getlist('files')
         if len(files) == 0 or len(files) > 1:
@@ -190,38 +247,45 @@ class ProjectViewSet(viewsets.ModelViewSet):
         for chunk in file.chunks():
             dest.write(chunk)
         dest.close()
-        src_parser = ExcelParser(file_path)
-        # 得到所有 sheet 页
-        sheet_names = src_parser.get_sheet_names()
-        # 循环 sheet 页
-        cases = []
-        for sheet_name in sheet_names:
-            holder = CaseInfoHolder(src_parser.work_book, sheet_name)
-            for case in holder.case_infos:
-                info = CaseInfo()
-                info.name = case.step
-                info.remark = case.description
-                info.method = case.method
-                info.run = False if case.run else True
-                info.host = None
-                info.path = case.path
-                info.headers = case.headers
-                info.check_status = False
-                info.delay = case.sleep if case.sleep else 0
-                info.params = json.loads(case.params) if case.params else None
-                info.sample = json.loads(case.response_content) if case.response_content and len(
-                    case.response_content) < 30000 and case.response_content != 'None' else None
-                info.project_id = project.id
-                build_extend(info, case.ex_keys, case.ex_values, cases)
-                build_expected(info, case.expected_key, case.expected_value, case.check_step)
-                info.owner = project.owner
-                case_info.create_case(info)
-                info.row = case.row
-                cases.append(info)
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        if params['processes']:
+            # 得到所有 sheet 页
+            src_parser = ExcelParser(file_path, read_only=True)
+            sheet_names = src_parser.get_sheet_names()
+            src_parser.close()
+            progress = ImportProgress(uuid.uuid4().hex, len(sheet_names))
+            progress.flush()
+            job.submit(project.owner, import_sheets, project, file_path, sheet_names, progress,
+                       processes=params['processes'])
+            return Response.success(progress.to_dict())
+        try:
+            # 只读模式流式解析，避免一次性加载整个工作簿
+            src_parser = ExcelParser(file_path, read_only=True)
+            # 循环 sheet 页，先在内存中构建所有用例，最后批量入库
+            cases = []
+            rows = {}
+            for sheet_name in src_parser.get_sheet_names():
+                holder = CaseInfoHolder(src_parser.work_book, sheet_name, streaming=True)
+                cases.extend(build_import_cases(project, holder.case_infos, rows))
+            src_parser.close()
+            case_info.bulk_create_cases(cases)
+        finally:
+            if os.path.exists(file_path):
+                os.remove(file_path)
         return Response.def_success()
 
+    @action(methods=['GET'], detail=False, url_path='temp-import-progress')
+    def import_progress(self, request):
+        """
+        查询旧版 Excel 后台导入的进度
+        """
+
+        data = parse_data(request, 'GET')
+        params = get_params(data, 'id')
+        progress = ImportProgress.get(params['id'])
+        if progress is None:
+            raise PlatformError.error_args(ErrorCode.DATA_NOT_EXISTED, '导入任务', 'id')
+        return Response.success(progress)
+
     @action(methods=['GET'], detail=False, url_path='temp-export')
     def exported(self, request):
         """
@@ -233,10 +297,11 @@ class ProjectViewSet(viewsets.ModelViewSet):
         project = get_by_id(params['project_id'])
         case_infos = CaseInfo.objects.owner().exact(project_id=project.id)
         file_name = project.name + '_' + str(int(time.time() * 1000)) + '.xlsx'
-        file_path = os.path.join(FILE_REPO, file_name)
-        writer = ExcelWriter(filename=file_path, sheet_name='sheet')
+        # 写入内存缓冲，超过大小后才转存临时文件，关闭后自动删除
+        file = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+        writer = ExcelWriter(filename=file, sheet_name='sheet', write_only=True)
         writer.write(case_infos)
-        file = open(file_path, 'rb')
+        file.seek(0)
         response = FileResponse(file)
         response['Content-Type'] = 'application/octet-stream'
         response['Content-Disposition'] = 'attachment;filename=' + file_name
@@ -246,15 +311,16 @@ class ProjectViewSet(viewsets.ModelViewSet):
     def statistics(self, request):
         """
         首页的统计数据
-        """
 
-        # 查询所有项目
-        # 查询所有接口
-        # 查询所有记录
+        项目数、用例数、记录数在增删时增量更新缓存，缓存不存在时重新计算
+        """
 
-        return Response.success({'project': Project.objects.owner().count(),
-                                 'case': case_info.count(),
-                                 'record': record.count()})
+        parse_data(request, 'GET')
+        return Response.success(statistics.get(UserHolder.current_user(), {
+            statistics.PROJECT: count,
+            statistics.CASE: case_info.count,
+            statistics.RECORD: record.count
+        }))
 
 
 # -------------------------------------------- 以上为 RESTFUL 接口，以下为调用接口 -----------------------------------------
@@ -271,6 +337,14 @@ def get_by_id(id):
     return project
 
 
+def count():
+    """
+    查询项目总数
+    """
+
+    return Project.objects.owner().count()
+
+
 def get_list_by_ids(ids):
     """
     根据 id 数组查询
@@ -279,9 +353,204 @@ def get_list_by_ids(ids):
     return Project.objects.owner().fields_in(id=ids)
 
 
-def count_by_group(group_id):
+def prepare_execute(id):
     """
-    统计指定 group id 下项目数
+    执行项目前的准备
+
+    查询项目以及项目下的用例，创建执行中的测试记录
+    报告直接引用用例的快照，执行时不查询压缩存储的结果示例
     """
 
-    return Project.objects.filter(owner=UserHolder.current_user(), group_id=group_id).count()
+    project = get_by_id(id)
+    case_infos = list(case_info.list_by_project(project.id).defer('sample'))
+    if not case_infos:
+        raise PlatformError.error(ErrorCode.PROJECT_NOT_HAVE_CASES)
+    case_info.fill_snapshots(case_infos)
+    reco = record.create(group_id=project.group_id, project_id=project.id, owner=project.owner,
+                         total=len(case_infos), status=RUNNING)
+    # 排队期间也保持心跳，避免被当作已中断的记录
+    job.heartbeat.watch(reco.id)
+    return project, case_infos, reco
+
+
+def run_project(project, case_infos, reco, workers=None, engine=None, pool_size=None, batch_size=None,
+                limiter=None):
+    """
+    执行项目下的用例，生成用例报告并更新测试记录
+
+    用例报告在执行过程中分批写入，测试记录的统计随之增量更新
+    """
+
+    progress = Progress(reco.id, len(case_infos))
+    progress.flush()
+    sink = report.ReportSink(reco, batch_size)
+
+    def listener(result):
+        sink.add(result)
+        progress.update(result)
+
+    status = ERROR
+    try:
+        executor = Executor(case_infos=case_infos, project=project, workers=workers, engine=engine,
+                            pool_size=pool_size, listener=listener, release=True, limiter=limiter)
+        executor.execute()
+        status = FINISHED
+    finally:
+        # 执行失败时也保留已经完成的报告
+        sink.close()
+        reco.refresh_from_db()
+        record.finish(reco, status)
+        progress.finish(status)
+        job.heartbeat.unwatch(reco.id)
+    return reco
+
+
+def list_for_batch(group_id, ids):
+    """
+    查询需要批量执行的项目
+
+    ids 可以是数组，也可以是逗号分隔的字符串
+    """
+
+    if group_id:
+        project_group.get_by_id(group_id)
+        return list(Project.objects.owner().filter(group_id=group_id))
+    if not ids:
+        return []
+    if isinstance(ids, str):
+        ids = [id for id in ids.split(',') if id.strip()]
+    return list(get_list_by_ids(ids))
+
+
+def prepare_batch(projects):
+    """
+    批量执行前的准备
+
+    为每个项目创建执行中的测试记录，没有用例的项目会被跳过
+    返回 (项目, 用例, 测试记录) 的数组以及跳过的项目
+    """
+
+    executions = []
+    skipped = []
+    for pro in projects:
+        try:
+            executions.append(prepare_execute(pro.id))
+        except PlatformError:
+            skipped.append({'project_id': pro.id, 'project_name': pro.name})
+    return executions, skipped
+
+
+def run_batch(executions, workers=None, host_limit=None, engine=None, batch_size=None):
+    """
+    并发执行多个项目
+
+    所有项目共享同一个按 host 的限流器，执行结果保存在各自的测试记录中，由 summarize_batch 汇总
+    """
+
+    limiter = HostLimiter(host_limit if host_limit else BATCH_HOST_LIMIT)
+
+    def run(execution):
+        pro, case_infos, reco = execution
+        try:
+            run_project(pro, case_infos, reco, engine=engine, batch_size=batch_size, limiter=limiter)
+        except Exception as e:
+            LOGGER.exception(e)
+
+    job.map_all(UserHolder.current_user(), run, executions, workers if workers else BATCH_WORKERS)
+
+
+def summarize_batch(batch, progresses):
+    """
+    汇总批量执行中各个测试记录的执行进度
+    """
+
+    statuses = [o['status'] for o in progresses]
+    if RUNNING in statuses:
+        status = RUNNING
+    else:
+        status = ERROR if ERROR in statuses else FINISHED
+    return {
+        'id': batch['id'],
+        'status': status,
+        'projects': batch['projects'],
+        'skipped': batch['skipped'],
+        'running': statuses.count(RUNNING),
+        'finished': statuses.count(FINISHED),
+        'error': statuses.count(ERROR),
+        'total': sum(o['total'] for o in progresses),
+        'done': sum(o['done'] for o in progresses),
+        'passed': sum(o['passed'] for o in progresses),
+        'failed': sum(o['failed'] for o in progresses),
+        'ignored': sum(o['ignored'] for o in progresses),
+        'records': progresses
+    }
+
+
+def build_import_cases(project, cases, rows):
+    """
+    将旧版 Excel 中解析出的用例转换为项目下的用例
+
+    rows 为行号到用例的映射，跨 sheet 页共享，多个 sheet 页行号相同时依赖第一个
+    """
+
+    infos = []
+    for case in cases:
+        info = CaseInfo()
+        info.name = case.step
+        info.remark = case.description
+        info.method = case.method
+        info.run = False if case.run else True
+        info.host = None
+        info.path = case.path
+        info.headers = case.headers
+        info.check_status = False
+        info.delay = case.sleep if case.sleep else 0
+        info.params = json.loads(case.params) if case.params else None
+        info.sample = json.loads(case.response_content) if case.response_content and len(
+            case.response_content) < 30000 and case.response_content != 'None' else None
+        info.project_id = project.id
+        build_extend(info, case.ex_keys, case.ex_values, rows)
+        build_expected(info, case.expected_key, case.expected_value, case.check_step)
+        info.owner = project.owner
+        info.row = case.row
+        rows.setdefault(case.row, info)
+        infos.append(info)
+    return infos
+
+
+def import_sheets(project, file_path, sheet_names, progress, processes=None):
+    """
+    多进程并行解析各个 sheet 页后合并入库
+
+    1. 每个 sheet 页在独立进程中解析，只返回字段字典
+       任务线程所在的进程是多线程的，fork 时其他线程持有的锁(日志、数据库、Redis 连接池)会被带入子进程导致死锁，
+       子进程以 spawn 方式启动，初始化 Django 后各自打开工作簿
+    2. 解析完成后按 sheet 页原有顺序构建用例，保证跨行依赖的解析结果与顺序导入一致
+    3. 所有用例在一个事务中批量入库
+    """
+
+    try:
+        processes = min(max(1, int(processes)), os.cpu_count() or 1, max(1, len(sheet_names)))
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=django.setup) as pool:
+            futures = [pool.submit(parse_sheet, file_path, sheet_name) for sheet_name in sheet_names]
+            for future in as_completed(futures):
+                progress.update(len(future.result()))
+            sheets = [future.result() for future in futures]
+        cases = []
+        rows = {}
+        for sheet in sheets:
+            holders = []
+            for values in sheet:
+                holder = CaseInfo()
+                holder.__dict__.update(values)
+                holders.append(holder)
+            cases.extend(build_import_cases(project, holders, rows))
+        case_info.bulk_create_cases(cases)
+        progress.finish(FINISHED)
+    except Exception as e:
+        progress.finish(ERROR, str(e))
+        raise
+    finally:
+        if os.path.exists(file_path):
+            os.remove(file_path)
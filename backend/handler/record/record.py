@@ -1,18 +1,32 @@
+import csv
+import json
+import tempfile
+import time
+from datetime import timedelta
+from itertools import chain, islice
+import openpyxl
 from django.core.exceptions import ObjectDoesNotExist
-from django.core.paginator import Paginator
+from django.db import transaction
+from django.db.models import Avg, Count, Max, Q, Sum
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils import timezone
 from rest_framework import serializers, viewsets
 from rest_framework.decorators import action
 from backend.exception import ErrorCode, PlatformError
-from backend.models import Record, Report
-from backend.handler.project import project, project_group
-from backend.util import UserHolder, Response, parse_data, page_params, save
+from backend.handler.record import report
+from backend.models import Record, Report, Project, ProjectGroup, RecordSummary
+from backend.settings import RUNNING, ERROR, PASSED, IGNORED, JOB_HEARTBEAT_TIMEOUT, EXPORT_SPOOL_SIZE, EXPORT_CHUNK_SIZE, \
+    EXCEL_CELL_MAX_LENGTH, ANALYTICS_WINDOW, ANALYTICS_MAX_WINDOW
+from backend.util import UserHolder, Response, parse_data, get_params, page_params, paginate, save, update_fields, \
+    statistics, analytics
+from backend.util.job import Progress, heartbeat
 
 
 class RecordSerializer(serializers.ModelSerializer):
     class Meta:
         model = Record
-        fields = ['id', 'group_id', 'project_id', 'remark', 'passed', 'failed', 'ignored', 'total', 'created_at',
-                  'updated_at']
+        fields = ['id', 'group_id', 'project_id', 'remark', 'passed', 'failed', 'ignored', 'total', 'status',
+                  'created_at', 'updated_at']
 
 
 class RecordViewSet(viewsets.ModelViewSet):
@@ -25,16 +39,25 @@ class RecordViewSet(viewsets.ModelViewSet):
         根据 id 删除记录
 
         前端需要二次确认，确认删除执行以下操作：
-        1. 删除记录
+        1. 删除记录以及执行汇总
         2. 删除所属用例结果
+        3. 提交后在独立的事务中删除不再被引用的报告内容
         """
 
         parse_data(request, 'DELETE')
         id = kwargs['pk']
         record = get_by_id(id)
-        record.delete()
-        # 删除用例执行结果
-        Report.objects.owner().filter(record_id=id).delete()
+        hashes = set()
+        with transaction.atomic():
+            record.delete()
+            statistics.incr(statistics.RECORD, -1)
+            RecordSummary.objects.owner().filter(record_id=id).delete()
+            reports = Report.objects.owner().filter(record_id=id)
+            for snapshot_hash, content_hash in reports.values_list('snapshot_hash', 'content_hash'):
+                hashes.add(snapshot_hash)
+                hashes.add(content_hash)
+            reports.delete()
+        report.delete_payloads(hashes)
         return Response.def_success()
 
     def list(self, request, *args, **kwargs):
@@ -44,28 +67,84 @@ class RecordViewSet(viewsets.ModelViewSet):
         可全量分页(当然只有自己的数据)
         可传入项目分组
         可传入项目
+        传入 cursor 时使用游标分页，第一页传空值
         """
 
         data = parse_data(request, 'GET')
         page, page_size, name, group_id, project_name = page_params(data, 'name', 'group_id', 'project_name').values()
-        records = Record.objects.filter(owner=UserHolder.current_user()).exact(group_id=group_id)
-        page_projects = Paginator(records, page_size)
-        result = page_projects.page(page)
-        group_ids = [o.group_id for o in result.object_list]
-        groups = project_group.get_list_by_ids(group_ids)
-        group_names = {o.id: o.name for o in groups}
-        project_ids = [o.project_id for o in result.object_list]
-        projects = project.get_list_by_ids(project_ids)
-        project_names = {o.id: o.name for o in projects}
-        for record in result.object_list:
-            record.group_name = group_names[record.group_id]
-            record.project_name = project_names[record.project_id]
+        records = Record.objects.filter(owner=UserHolder.current_user()).exact(group_id=group_id) \
+            .join_name(ProjectGroup, 'group_id', 'group_name').join_name(Project, 'project_id', 'project_name')
+        result = paginate(records, data, page, page_size)
         return Response.success(result)
 
-    @action(methods=['GET'], detail=False, url_path='export')
-    def export(self, request, id):
-        # TODO 导出 Excel
-        print()
+    @action(methods=['GET'], detail=True, url_path='progress')
+    def progress(self, request, pk):
+        """
+        查询记录的执行进度
+
+        执行中的记录从缓存中取实时进度，缓存不存在时以记录中的统计为准
+        执行进程已退出的记录标记为执行失败，不再返回缓存中的进度
+        """
+
+        parse_data(request, 'GET')
+        return Response.success(get_progress(get_by_id(pk)))
+
+    @action(methods=['GET'], detail=True, url_path='export')
+    def export(self, request, pk):
+        """
+        导出记录下所有用例执行结果
+
+        1. 传入 type 为 xlsx 时导出 Excel，否则导出 csv
+        2. 用例结果分批从数据库中读取，不一次性加载到内存
+        3. csv 边生成边返回，Excel 以只写模式写入缓冲后返回
+        """
+
+        data = parse_data(request, 'GET')
+        params = get_params(data, 'type')
+        record = get_by_id(pk)
+        file_name = 'record_' + str(record.id) + '_' + str(int(time.time() * 1000))
+        if params['type'] == 'xlsx':
+            response = FileResponse(export_xlsx(record.id))
+            file_name += '.xlsx'
+        else:
+            response = StreamingHttpResponse(export_csv(record.id))
+            file_name += '.csv'
+        response['Content-Type'] = 'application/octet-stream'
+        response['Content-Disposition'] = 'attachment;filename=' + file_name
+        return response
+
+    @action(methods=['GET'], detail=False, url_path='project-trend')
+    def project_trend(self, request):
+        """
+        项目的通过率以及耗时趋势
+
+        1. 窗口为最近 limit 次执行，传入 days 时只取最近 days 天内的执行
+        2. 只查询执行汇总，查询量与执行次数成正比，与用例报告数量无关
+        3. 窗口内的百分位由各次执行的耗时直方图合并估算，取所在区间的上限
+        """
+
+        data = parse_data(request, 'GET')
+        params = get_params(data, 'project_id')
+        if not params['project_id']:
+            raise PlatformError.error_args(ErrorCode.MISSING_NECESSARY_KEY, 'project_id')
+        summaries = window(RecordSummary.objects.owner().filter(project_id=params['project_id']), data)
+        return Response.success(project_trend(summaries))
+
+    @action(methods=['GET'], detail=False, url_path='case-trend')
+    def case_trend(self, request):
+        """
+        用例的通过率、耗时以及不稳定度趋势
+
+        1. 窗口为该用例最近 limit 次执行，传入 days 时只取最近 days 天内的执行
+        2. 按用例、记录索引查询用例报告，查询量与执行次数成正比
+        """
+
+        data = parse_data(request, 'GET')
+        params = get_params(data, 'case_id')
+        if not params['case_id']:
+            raise PlatformError.error_args(ErrorCode.MISSING_NECESSARY_KEY, 'case_id')
+        reports = window(Report.objects.owner().filter(case_id=params['case_id']), data)
+        return Response.success(case_trend(reports))
 
 
 # -------------------------------------------- 以上为 RESTFUL 接口，以下为调用接口 -----------------------------------------
@@ -82,6 +161,14 @@ def get_by_id(id):
     return record
 
 
+def get_list_by_ids(ids):
+    """
+    根据 id 数组查询
+    """
+
+    return Record.objects.owner().fields_in(id=ids)
+
+
 def count():
     """
     查询记录总数
@@ -97,4 +184,252 @@ def create(**kwargs):
 
     record = Record(**kwargs)
     save(record)
+    statistics.incr(statistics.RECORD, owner=record.owner)
+    return record
+
+
+def finish(record, status, **kwargs):
+    """
+    结束测试记录，更新执行状态以及统计
+    """
+
+    update_fields(record, status=status, **kwargs)
+    save(record)
+    summarize(record)
     return record
+
+
+def summarize(record):
+    """
+    汇总测试记录的执行结果以及耗时，保存为执行汇总
+
+    执行结束时调用一次，耗时由数据库排序后取回，忽略的用例不参与耗时统计
+    """
+
+    values = list(Report.objects.filter(owner=record.owner, record_id=record.id).exclude(status=IGNORED)
+                  .order_by('time_used').values_list('time_used', flat=True))
+    summary, _ = RecordSummary.objects.update_or_create(
+        record_id=record.id,
+        defaults=dict(owner=record.owner, group_id=record.group_id, project_id=record.project_id,
+                      status=record.status, total=record.total, passed=record.passed, failed=record.failed,
+                      ignored=record.ignored, **analytics.rollup(values)))
+    return summary
+
+
+def is_stale(record):
+    """
+    记录创建后是否已经超过心跳超时，刚创建的记录可能还没有写入心跳
+    """
+
+    return record.updated_at < timezone.now() - timedelta(seconds=JOB_HEARTBEAT_TIMEOUT)
+
+
+def expire(record):
+    """
+    将执行进程已退出的记录标记为执行失败，已经不是执行中时返回 False
+    """
+
+    if not Record.objects.filter(id=record.id, status=RUNNING).update(status=ERROR, updated_at=timezone.now()):
+        return False
+    record.refresh_from_db()
+    summarize(record)
+    return True
+
+
+def get_progress(record):
+    """
+    查询记录的执行进度
+
+    执行中的记录从缓存中取实时进度，缓存不存在时以记录中的统计为准
+    执行进程已退出的记录标记为执行失败，不再返回缓存中的进度
+    """
+
+    expired = False
+    if record.status == RUNNING and is_stale(record) and not heartbeat.alive([record.id]):
+        expired = expire(record)
+    progress = None if expired else Progress.get(record.id)
+    if progress is None:
+        done = record.total if record.status != RUNNING else record.passed + record.failed + record.ignored
+        progress = {
+            'id': record.id,
+            'status': record.status,
+            'total': record.total,
+            'done': done,
+            'passed': record.passed,
+            'failed': record.failed,
+            'ignored': record.ignored
+        }
+    return progress
+
+
+def expire_orphans():
+    """
+    检查所有执行中的记录，没有心跳的标记为执行失败
+
+    由心跳线程定期调用，进程重启后遗留的记录也会在心跳线程启动后被清理
+    """
+
+    cutoff = timezone.now() - timedelta(seconds=JOB_HEARTBEAT_TIMEOUT)
+    records = list(Record.objects.filter(status=RUNNING, updated_at__lt=cutoff))
+    alive = heartbeat.alive([o.id for o in records])
+    for o in records:
+        if o.id not in alive:
+            expire(o)
+
+
+def window(queryset, data):
+    """
+    按趋势分析的窗口过滤，最近的执行在前
+
+    limit 为执行次数，默认 ANALYTICS_WINDOW，最大 ANALYTICS_MAX_WINDOW
+    days 为最近的天数，不传时不限制
+    """
+
+    params = get_params(data, 'limit', 'days')
+    try:
+        limit = int(params['limit']) if params['limit'] else ANALYTICS_WINDOW
+        days = int(params['days']) if params['days'] else None
+    except (TypeError, ValueError):
+        raise PlatformError.error(ErrorCode.VALIDATION_ERROR)
+    if limit <= 0 or (days is not None and days <= 0):
+        raise PlatformError.error(ErrorCode.VALIDATION_ERROR)
+    if days:
+        queryset = queryset.filter(created_at__gte=timezone.now() - timedelta(days=days))
+    return queryset.order_by('-record_id')[:min(limit, ANALYTICS_MAX_WINDOW)]
+
+
+def project_trend(summaries):
+    """
+    根据执行汇总计算项目趋势
+
+    窗口内的数量、耗时合计由数据库聚合，时间序列按执行先后排列
+    """
+
+    total = summaries.aggregate(runs=Count('id'), passed=Sum('passed'), failed=Sum('failed'),
+                                ignored=Sum('ignored'), time_sum=Sum('time_sum'), time_max=Max('time_max'))
+    series = list(summaries.values('record_id', 'status', 'total', 'passed', 'failed', 'ignored', 'time_sum',
+                                   'time_max', 'p50', 'p95', 'p99', 'histogram', 'created_at'))
+    series.reverse()
+    histogram = analytics.merge(o.pop('histogram') for o in series)
+    for o in series:
+        o['pass_rate'] = analytics.pass_rate(o['passed'], o['failed'])
+    passed, failed = total['passed'] or 0, total['failed'] or 0
+    return {
+        'runs': total['runs'],
+        'passed': passed,
+        'failed': failed,
+        'ignored': total['ignored'] or 0,
+        'pass_rate': analytics.pass_rate(passed, failed),
+        'time_avg': round(total['time_sum'] / (passed + failed)) if passed + failed else None,
+        'time_max': total['time_max'],
+        'p50': analytics.histogram_percentile(histogram, 50),
+        'p95': analytics.histogram_percentile(histogram, 95),
+        'p99': analytics.histogram_percentile(histogram, 99),
+        'series': series
+    }
+
+
+def case_trend(reports):
+    """
+    根据用例报告计算用例趋势
+
+    窗口内的数量、平均耗时由数据库聚合，百分位以及不稳定度根据按执行先后排列的结果计算
+    """
+
+    executed = ~Q(status=IGNORED)
+    total = reports.aggregate(runs=Count('id'), passed=Count('id', filter=Q(status=PASSED)),
+                              failed=Count('id', filter=~Q(status__in=[PASSED, IGNORED])),
+                              ignored=Count('id', filter=Q(status=IGNORED)),
+                              time_avg=Avg('time_used', filter=executed), time_max=Max('time_used', filter=executed))
+    series = list(reports.values('record_id', 'status', 'time_used', 'http_status', 'created_at'))
+    series.reverse()
+    values = sorted(o['time_used'] for o in series if o['status'] != IGNORED)
+    return {
+        'runs': total['runs'],
+        'passed': total['passed'],
+        'failed': total['failed'],
+        'ignored': total['ignored'],
+        'pass_rate': analytics.pass_rate(total['passed'], total['failed']),
+        'flakiness': analytics.flakiness([o['status'] for o in series]),
+        'time_avg': round(total['time_avg']) if total['time_avg'] is not None else None,
+        'time_max': total['time_max'],
+        'p50': analytics.percentile(values, 50),
+        'p95': analytics.percentile(values, 95),
+        'p99': analytics.percentile(values, 99),
+        'series': series
+    }
+
+
+# 导出用例结果的列
+EXPORT_FIELDS = ['case_id', 'name', 'remark', 'method', 'host', 'path', 'params', 'headers', 'status', 'http_status',
+                 'response_code', 'time_used', 'response_content']
+
+
+def iter_reports(record_id):
+    """
+    按导出列逐行生成记录下的用例执行结果
+
+    使用 iterator 分批读取报告，每批一次查询取回报告内容
+    查询在调用时立即构建，流式响应在视图返回后才迭代，此时不一定还能取到当前用户
+    """
+
+    reports = Report.objects.owner().filter(record_id=record_id) \
+        .only('id', 'name', 'case_id', 'status', 'http_status', 'response_code', 'time_used', 'snapshot_hash',
+              'content_hash').iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    return iter_rows(reports)
+
+
+def iter_rows(reports):
+    """
+    按批填回报告内容后逐行生成导出列
+    """
+
+    for chunk in iter(lambda: list(islice(reports, EXPORT_CHUNK_SIZE)), []):
+        report.attach_payloads(chunk)
+        for o in chunk:
+            yield [json.dumps(value, ensure_ascii=False) if isinstance(value, (dict, list)) else value
+                   for value in (getattr(o, field) for field in EXPORT_FIELDS)]
+
+
+class Echo:
+    """
+    只返回写入内容的伪文件对象，供 csv 逐行生成
+    """
+
+    def write(self, value):
+        return value
+
+
+def export_csv(record_id):
+    """
+    返回逐行生成 csv 内容的迭代器
+    """
+
+    rows = iter_reports(record_id)
+    writer = csv.writer(Echo())
+    # 带 BOM 头，避免 Excel 打开中文乱码
+    header = '\ufeff' + writer.writerow(EXPORT_FIELDS)
+    return chain([header], (writer.writerow(values) for values in rows))
+
+
+def export_xlsx(record_id):
+    """
+    以只写模式逐行写入 Excel，返回已回到开头的缓冲文件
+    """
+
+    work_book = openpyxl.Workbook(write_only=True)
+    sheet = work_book.create_sheet('sheet')
+    sheet.append(EXPORT_FIELDS)
+    for values in iter_reports(record_id):
+        # 单元格长度有上限，超出部分截断
+        sheet.append([value[:EXCEL_CELL_MAX_LENGTH] if isinstance(value, str) else value for value in values])
+    # 写入内存缓冲，超过大小后才转存临时文件，关闭后自动删除
+    file = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+    work_book.save(file)
+    work_book.close()
+    file.seek(0)
+    return file
+
+
+# 定期清理执行进程已退出的记录，心跳线程在当前进程第一次提交任务或者执行记录时启动
+heartbeat.on_sweep(expire_orphans)
@@ -1,10 +1,14 @@
+import hashlib
 import json
+import threading
 from django.core.exceptions import ObjectDoesNotExist
-from django.core.paginator import Paginator
+from django.db import transaction
+from django.db.models import F
 from rest_framework import serializers, viewsets
 from backend.exception import ErrorCode, PlatformError
-from backend.models import Report
-from backend.util import UserHolder, Response, parse_data, page_params, save
+from backend.models import Report, Record, Payload, CaseInfo
+from backend.settings import PASSED, IGNORED, REPORT_BATCH_SIZE, SNAPSHOT_FIELDS
+from backend.util import UserHolder, Response, parse_data, page_params, paginate, save, batch_save
 
 
 class ReportSerializer(serializers.ModelSerializer):
@@ -25,6 +29,7 @@ class ReportViewSet(viewsets.ModelViewSet):
         可全量分页(当然只有自己的数据)
         可传入分组
         可传入 name 模糊
+        传入 cursor 时使用游标分页，第一页传空值，与页码分页一样按 sort 排序，相同 sort 的后写入的在前
         """
 
         data = parse_data(request, 'GET')
@@ -33,18 +38,19 @@ class ReportViewSet(viewsets.ModelViewSet):
             raise PlatformError.error_args(ErrorCode.MISSING_NECESSARY_KEY, 'record_id')
         projects = Report.objects.filter(owner=UserHolder.current_user()).exact(record_id=record_id)\
             .contains(name=name).exact(status=status)
-        page_projects = Paginator(projects, page_size)
-        result = page_projects.page(page)
+        result = paginate(projects, data, page, page_size, ordering=('sort', '-id'))
         return Response.success(result)
 
     def retrieve(self, request, *args, **kwargs):
         """
         根据 id 查询项目详细信息
+
+        将用例快照以及响应内容填回报告，返回与拆分前一致的结构
         """
 
         parse_data(request, 'GET')
         report = get_by_id(kwargs['pk'])
-        decoding(report)
+        attach_payloads([report])
         return Response.success(report)
 
 
@@ -71,16 +77,147 @@ def create(report):
     return report
 
 
-def decoding(report):
+def digest(content):
+    """
+    计算内容的 sha256，键排序后计算，相同内容的哈希一致
+    """
+
+    text = json.dumps(content, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def save_payloads(payloads):
+    """
+    保存报告内容，已存在的内容不再写入
+
+    payloads 为哈希到内容的映射，需要在写入报告或者用例的事务中调用
+    已存在的内容加锁，在报告写入提交前不会被 delete_payloads 删除
+    """
+
+    if not payloads:
+        return
+    existed = set(Payload.objects.select_for_update().filter(hash__in=list(payloads)).order_by('hash')
+                  .values_list('hash', flat=True))
+    Payload.objects.bulk_create([Payload(hash=hash, content=content) for hash, content in payloads.items()
+                                 if hash not in existed], ignore_conflicts=True)
+
+
+def get_payloads(hashes):
+    """
+    根据哈希查询报告内容，返回哈希到内容的映射
+    """
+
+    hashes = {hash for hash in hashes if hash}
+    if not hashes:
+        return {}
+    return dict(Payload.objects.filter(hash__in=hashes).values_list('hash', 'content'))
+
+
+def attach_payloads(reports):
     """
-    对部分参数进行解码操作
+    将用例快照以及响应内容填回报告对象，一次查询完成
     """
 
-    if report.extend_keys:
-        report.extend_keys = json.loads(report.extend_keys)
-    if report.extend_values:
-        report.extend_values = json.loads(report.extend_values)
-    if report.expected_keys:
-        report.expected_keys = json.loads(report.expected_keys)
-    if report.expected_values:
-        report.expected_values = json.loads(report.expected_values)
+    payloads = get_payloads([o.snapshot_hash for o in reports] + [o.content_hash for o in reports])
+    for report in reports:
+        snapshot = payloads.get(report.snapshot_hash) or {}
+        for field in SNAPSHOT_FIELDS:
+            setattr(report, field, snapshot.get(field))
+        report.response_content = payloads.get(report.content_hash)
+
+
+def delete_payloads(hashes):
+    """
+    删除不再被任何报告以及用例引用的内容
+
+    在独立的事务中先锁定内容再检查引用，与 save_payloads 互斥：
+    正在写入的报告提交后才检查引用，检查之后写入的报告会等待删除提交，再重新写入内容
+    锁定读不建立快照，之后检查引用的查询能看到已提交的报告，不能在已有查询的事务中调用
+    """
+
+    hashes = {hash for hash in hashes if hash}
+    if not hashes:
+        return
+    with transaction.atomic():
+        locked = set(Payload.objects.select_for_update().filter(hash__in=hashes).order_by('hash')
+                     .values_list('hash', flat=True))
+        if not locked:
+            return
+        referenced = set(Report.objects.filter(snapshot_hash__in=locked).values_list('snapshot_hash', flat=True))
+        referenced |= set(Report.objects.filter(content_hash__in=locked).values_list('content_hash', flat=True))
+        referenced |= set(CaseInfo.objects.filter(snapshot_hash__in=locked).values_list('snapshot_hash', flat=True))
+        Payload.objects.filter(hash__in=locked - referenced).delete()
+
+
+class ReportSink:
+    """
+    用例报告的流式持久化
+
+    用例执行完成即加入缓冲，缓冲达到批次大小时批量写入，同时增量更新测试记录的统计
+    """
+
+    def __init__(self, record, batch_size=REPORT_BATCH_SIZE):
+        self.record_id = record.id
+        self.owner = record.owner
+        self.batch_size = max(1, int(batch_size)) if batch_size else REPORT_BATCH_SIZE
+        self.buffer = []
+        self.lock = threading.Lock()
+
+    def add(self, report):
+        """
+        加入一条用例报告
+
+        转为新的报告对象后放入缓冲，执行器中的报告随后可以被释放
+        用例快照以及响应内容按哈希拆分为报告内容，报告中只保留哈希
+        用例快照在保存用例时已经写入，直接引用用例的快照哈希，没有快照哈希时才在此计算
+        """
+
+        entity = Report(name=report.name, sort=report.sort, case_id=report.case_id, status=report.status,
+                        response_code=report.response_code, http_status=report.http_status,
+                        time_used=report.time_used, record_id=self.record_id, owner=self.owner)
+        payloads = {}
+        entity.snapshot_hash = getattr(report, 'snapshot_hash', None)
+        if not entity.snapshot_hash:
+            snapshot = {field: getattr(report, field, None) for field in SNAPSHOT_FIELDS}
+            entity.snapshot_hash = digest(snapshot)
+            payloads[entity.snapshot_hash] = snapshot
+        if report.response_content is not None:
+            entity.content_hash = digest(report.response_content)
+            payloads[entity.content_hash] = report.response_content
+        with self.lock:
+            self.buffer.append((entity, payloads))
+            if len(self.buffer) < self.batch_size:
+                return
+            items = self.buffer
+            self.buffer = []
+        self.__flush(items)
+
+    def close(self):
+        """
+        写入缓冲中剩余的报告
+        """
+
+        with self.lock:
+            items = self.buffer
+            self.buffer = []
+        if items:
+            self.__flush(items)
+
+    def __flush(self, items):
+        """
+        批量写入报告内容、报告并累加测试记录的统计
+        """
+
+        reports = [entity for entity, _ in items]
+        payloads = {}
+        for _, item in items:
+            payloads.update(item)
+        passed = len([o for o in reports if o.status == PASSED])
+        ignored = len([o for o in reports if o.status == IGNORED])
+        failed = len(reports) - passed - ignored
+        with transaction.atomic():
+            save_payloads(payloads)
+            batch_save(Report.objects, reports)
+            Record.objects.filter(id=self.record_id).update(passed=F('passed') + passed,
+                                                             failed=F('failed') + failed,
+                                                             ignored=F('ignored') + ignored)
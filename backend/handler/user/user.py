@@ -1,11 +1,13 @@
 import hashlib
+import uuid
 from django.core.exceptions import ObjectDoesNotExist
 from django.http import HttpResponseRedirect
 from rest_framework import serializers, viewsets
 from rest_framework.decorators import action
 
 from backend.models import User
-from backend.util import Security, UserHolder, Response, parse_data, get_params
+from backend.settings import TOKEN_TIMEOUT
+from backend.util import Security, UserHolder, Response, parse_data, get_params, local_cache
 from django.core.cache import cache
 from backend.exception.exception import PlatformError
 from backend.exception import ErrorCode
@@ -47,8 +49,8 @@ class UserViewSet(viewsets.GenericViewSet):
             token = Security.encode(user.id)
             user.password = token
             user.token = token
-            # token 5 分钟有效
-            cache.set(token, user.id, timeout=60 * 60 * 24 * 7)
+            # token 7 天有效
+            cache.set(token, user.id, timeout=TOKEN_TIMEOUT)
             return Response.success(user)
 
     @action(methods=['POST'], detail=False, url_path='signout')
@@ -60,12 +62,28 @@ class UserViewSet(viewsets.GenericViewSet):
         """
         # 找到当前 token
         token = UserHolder.current_token()
-        # 删除 token
-        if cache.has_key(token):
-            # 直接过期
-            cache.expire(0)
+        # 删除 token 以及进程内的缓存
+        if token:
+            cache.delete(token)
+            local_cache.tokens.delete(token)
         return HttpResponseRedirect('/')
 
+    @action(methods=['POST'], detail=False, url_path='secret')
+    def reset_secret(self, request):
+        """
+        更换访问密钥
+
+        旧密钥立即失效，并清除进程内的缓存
+        """
+
+        parse_data(request, 'POST')
+        user = get_by_id(UserHolder.current_user())
+        secret = uuid.uuid4().hex
+        # 密码字段保存的是 md5，不走完整校验，只更新密钥
+        User.objects.filter(id=user.id).update(secret=secret)
+        local_cache.secrets.delete(user.secret)
+        return Response.success({'secret': secret})
+
     def register(self, request):
         pass
 
@@ -81,3 +99,15 @@ def get_by_secret(secret):
     except ObjectDoesNotExist:
         raise PlatformError.error_args(ErrorCode.DATA_NOT_EXISTED, '用户', 'secret')
     return user
+
+
+def get_by_id(id):
+    """
+    根据 id 查询用户
+    """
+
+    try:
+        user = User.objects.get(id=id)
+    except ObjectDoesNotExist:
+        raise PlatformError.error_args(ErrorCode.DATA_NOT_EXISTED, '用户', 'id')
+    return user
@@ -1,18 +1,30 @@
+import cProfile
+import hmac
+import os
+import random
 import re
+import time
 
+from backend.settings import TOKEN_TIMEOUT, TOKEN_REFRESH_INTERVAL, AUTH_IGNORES, REQUEST_TIMING_LOG, \
+    PROFILE_SAMPLE_RATE, PROFILE_SLOW_THRESHOLD, METRICS_TOKEN
+from backend.util import local_cache
 from backend.util.jwt_token import UserHolder
+from backend.util.metrics import RequestStats, metrics, record_query
 from backend.exception import ErrorCode, ValidateError, PlatformError
 from backend.util.resp_data import Response
 from backend import LOGGER
 from backend.handler.user import user
 from django.core.cache import cache
+from django.db import connection
+from testing_platform.settings import PROFILE_REPO
 
 try:
     from django.utils.deprecation import MiddlewareMixin
 except ImportError:
     MiddlewareMixin = object
 
-ignores = [re.compile('^/$'), re.compile('/user/signin'), re.compile('js$'), re.compile('css$'), re.compile('swagger')]
+# 所有忽略规则合并为一个正则，每次请求只匹配一次
+ignores = re.compile('|'.join('(?:' + pattern + ')' for pattern in AUTH_IGNORES))
 
 
 class RequestMiddleware(MiddlewareMixin):
@@ -22,64 +34,109 @@ class RequestMiddleware(MiddlewareMixin):
 
         1. 忽略部分路径规则
         2. 解析出 token 缓存当前用户
+        3. 先清除线程中上一个请求遗留的用户以及 token
         """
 
-        allowed = False
-        for ignore in ignores:
-            if re.match(ignore, request.path):
-                allowed = True
-                break
+        request.started_at = time.perf_counter()
+        UserHolder.clear()
+        try:
+            return self.__authenticate(request)
+        finally:
+            request.auth_used = time.perf_counter() - request.started_at
+
+    def __authenticate(self, request):
+        """
+        按忽略规则以及认证信息登录
+        """
+
+        allowed = ignores.match(request.path) is not None or self.__scrape_metrics(request)
 
         # 不被忽略则按规则校验
         if not allowed:
             # 取出请求头，失败跳回首页
             headers = request.headers
+            # 登录失败时返回失败结果，不能继续进入视图
             try:
                 token = headers['Authorization']
-                self.__login_with_token(token)
+                return self.__login_with_token(token)
             except KeyError:
                 try:
                     token = request.GET['auth']
-                    self.__login_with_token(token)
+                    return self.__login_with_token(token)
                 except Exception:
                     try:
                         secret = headers['Platform-Secret']
-                        self.__login_with_secret(secret)
+                        return self.__login_with_secret(secret)
                     except KeyError:
                         return Response.failed(ErrorCode.REQUIRE_LOGIN)
 
 
+    @staticmethod
+    def __scrape_metrics(request):
+        """
+        使用配置的 token 抓取指标接口，不需要登录
+        """
+
+        if not METRICS_TOKEN or request.path != '/metrics/':
+            return False
+        authorization = request.headers.get('Authorization', '')
+        return hmac.compare_digest(authorization.encode('utf-8'), ('Bearer ' + METRICS_TOKEN).encode('utf-8'))
+
     def __login_with_token(self, token):
+        """
+        根据 token 登录
+
+        先取进程内缓存，未命中再取 Redis，过期时间的刷新有最小间隔，不在每次请求时都刷新
+        """
+
         # 认证信息不以 token 开头重定向会首页
         if not token or not token.startswith('token '):
             return Response.failed(ErrorCode.MISSING_AUTHORITY)
         # 取真实 token
         token = token.replace('token ', '', 1)
         # 取 token 的缓存
-        user_id = cache.get(token)
+        item = local_cache.tokens.get(token)
+        if item is None:
+            user_id = cache.get(token)
+            refreshed_at = 0
+        else:
+            user_id, refreshed_at = item
         # 不存在则 token 过期，跳首页
         if not user_id:
             return Response.failed(ErrorCode.REQUIRE_LOGIN)
         # 重置过期时间
-        cache.expire(token, timeout=60 * 60 * 24 * 7)
-        # 缓存当前用户 id
+        now = time.time()
+        if now - refreshed_at >= TOKEN_REFRESH_INTERVAL:
+            cache.expire(token, timeout=TOKEN_TIMEOUT)
+            refreshed_at = now
+        local_cache.tokens.set(token, (user_id, refreshed_at))
+        # 缓存当前用户 id 以及 token
         UserHolder.cache_user(user_id)
+        UserHolder.cache_token(token)
 
     def __login_with_secret(self, secret):
         # 根据 secret 获取当前用户
         if not secret:
             return Response.failed(ErrorCode.MISSING_AUTHORITY)
-        try:
-            user_info = user.get_by_secret(secret)
-            # 缓存当前用户 id
-            UserHolder.cache_user(user_info.id)
-        except PlatformError:
-            return Response.failed(ErrorCode.MISSING_AUTHORITY)
+        user_id = local_cache.secrets.get(secret)
+        if user_id is None:
+            try:
+                user_id = user.get_by_secret(secret).id
+            except PlatformError:
+                return Response.failed(ErrorCode.MISSING_AUTHORITY)
+            local_cache.secrets.set(secret, user_id)
+        # 缓存当前用户 id
+        UserHolder.cache_user(user_id)
 
     def process_response(self, request, response):
         """
         统一返回封装
+
+        开启耗时日志时记录认证耗时以及请求总耗时
         """
+        if REQUEST_TIMING_LOG and hasattr(request, 'started_at'):
+            LOGGER.info('%s %s %s auth: %.2fms, total: %.2fms', request.method, request.path, response.status_code,
+                        request.auth_used * 1000, (time.perf_counter() - request.started_at) * 1000)
         return response
 
 
@@ -99,3 +156,48 @@ class ExceptionMiddleware(MiddlewareMixin):
         else:
             LOGGER.error(exception)
             return Response.failed(ErrorCode.FAIL)
+
+
+class MetricsMiddleware:
+    """
+    请求指标统计
+
+    1. 按视图记录请求耗时、数据库查询次数及耗时、Redis 命令次数及耗时
+    2. 按采样率对请求进行性能分析，耗时超过阈值时将分析结果保存到 PROFILE_REPO
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        RequestStats.reset()
+        profiler = cProfile.Profile() if random.random() < PROFILE_SAMPLE_RATE else None
+        start = time.perf_counter()
+        with connection.execute_wrapper(record_query):
+            if profiler:
+                profiler.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                if profiler:
+                    profiler.disable()
+        used = time.perf_counter() - start
+        view = request.resolver_match.view_name if request.resolver_match else 'unknown'
+        metrics.observe(view, request.method, response.status_code, used, RequestStats.current())
+        RequestStats.clear()
+        if profiler and used >= PROFILE_SLOW_THRESHOLD:
+            self.__dump(profiler, view, used)
+        return response
+
+    @staticmethod
+    def __dump(profiler, view, used):
+        """
+        保存慢请求的性能分析结果，可使用 pstats 或 snakeviz 查看
+        """
+
+        try:
+            os.makedirs(PROFILE_REPO, exist_ok=True)
+            file_name = '%s_%d_%dms.prof' % (re.sub(r'[^\w-]', '_', view), int(time.time() * 1000), used * 1000)
+            profiler.dump_stats(os.path.join(PROFILE_REPO, file_name))
+        except OSError as e:
+            LOGGER.error(e)
@@ -0,0 +1,19 @@
+# Generated by Django 3.1.2 on 2026-10-18 10:00
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0019_user_secret'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='record',
+            name='status',
+            field=models.CharField(default='FINISHED', max_length=8, validators=[django.core.validators.MinLengthValidator(1, message='最小长度为 1'), django.core.validators.MaxLengthValidator(8, message='最大长度为 8')], verbose_name='执行状态'),
+        ),
+    ]
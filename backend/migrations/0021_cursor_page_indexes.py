@@ -0,0 +1,21 @@
+# Generated by Django 3.1.2 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0020_record_status'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='record',
+            index=models.Index(fields=['owner', 'updated_at', 'id'], name='record_owner_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='report',
+            index=models.Index(fields=['owner', 'record_id', 'updated_at', 'id'], name='report_record_updated_idx'),
+        ),
+    ]
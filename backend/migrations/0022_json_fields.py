@@ -0,0 +1,102 @@
+# Generated by Django 3.1.2 on 2026-10-18 14:00
+
+import ast
+import json
+from django.db import migrations, models
+
+FIELDS = ['extend_keys', 'extend_values', 'expected_keys', 'expected_values']
+
+
+def normalize(value):
+    """
+    转为合法的 JSON 文本，空串以及无法解析的值置空
+    """
+
+    if value is None or value.strip() == '':
+        return None
+    try:
+        json.loads(value)
+        return value
+    except ValueError:
+        pass
+    # 未经编码直接保存的 Python 对象
+    try:
+        return json.dumps(ast.literal_eval(value))
+    except (ValueError, SyntaxError):
+        return None
+
+
+def forwards(apps, schema_editor):
+    """
+    修改列类型前先将已有数据修正为合法的 JSON 文本，否则数据库转换列类型时会失败
+    """
+
+    for name in ('CaseInfo', 'Report'):
+        model = apps.get_model('backend', name)
+        changed = []
+        for obj in model.objects.only('id', *FIELDS).order_by().iterator(chunk_size=2000):
+            dirty = False
+            for field in FIELDS:
+                value = getattr(obj, field)
+                normalized = normalize(value)
+                if normalized != value:
+                    setattr(obj, field, normalized)
+                    dirty = True
+            if dirty:
+                changed.append(obj)
+            if len(changed) >= 500:
+                model.objects.bulk_update(changed, FIELDS)
+                changed = []
+        if changed:
+            model.objects.bulk_update(changed, FIELDS)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0021_cursor_page_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='caseinfo',
+            name='expected_keys',
+            field=models.JSONField(blank=True, null=True, verbose_name='预期字段'),
+        ),
+        migrations.AlterField(
+            model_name='caseinfo',
+            name='expected_values',
+            field=models.JSONField(blank=True, null=True, verbose_name='预期值'),
+        ),
+        migrations.AlterField(
+            model_name='caseinfo',
+            name='extend_keys',
+            field=models.JSONField(blank=True, null=True, verbose_name='扩展字段'),
+        ),
+        migrations.AlterField(
+            model_name='caseinfo',
+            name='extend_values',
+            field=models.JSONField(blank=True, null=True, verbose_name='扩展值'),
+        ),
+        migrations.AlterField(
+            model_name='report',
+            name='expected_keys',
+            field=models.JSONField(blank=True, null=True, verbose_name='预期字段'),
+        ),
+        migrations.AlterField(
+            model_name='report',
+            name='expected_values',
+            field=models.JSONField(blank=True, null=True, verbose_name='预期值'),
+        ),
+        migrations.AlterField(
+            model_name='report',
+            name='extend_keys',
+            field=models.JSONField(blank=True, null=True, verbose_name='扩展字段'),
+        ),
+        migrations.AlterField(
+            model_name='report',
+            name='extend_values',
+            field=models.JSONField(blank=True, null=True, verbose_name='扩展值'),
+        ),
+    ]
@@ -0,0 +1,100 @@
+# Generated by Django 3.1.2 on 2026-10-18 16:00
+
+import hashlib
+import json
+from django.db import migrations, models
+
+SNAPSHOT_FIELDS = ['remark', 'method', 'host', 'path', 'params', 'headers', 'extend_keys', 'extend_values',
+                   'expected_keys', 'expected_values', 'expected_http_status', 'check_status', 'run', 'developer',
+                   'project_id', 'delay', 'sample']
+
+
+def digest(content):
+    """
+    与 backend.handler.record.report.digest 保持一致
+    """
+
+    text = json.dumps(content, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def forwards(apps, schema_editor):
+    """
+    将已有报告中的用例快照以及响应内容拆分到报告内容表中
+    """
+
+    Report = apps.get_model('backend', 'Report')
+    Payload = apps.get_model('backend', 'Payload')
+
+    def flush(reports, payloads):
+        existed = set(Payload.objects.filter(hash__in=list(payloads)).values_list('hash', flat=True))
+        Payload.objects.bulk_create([Payload(hash=hash, content=content) for hash, content in payloads.items()
+                                     if hash not in existed], ignore_conflicts=True)
+        Report.objects.bulk_update(reports, ['snapshot_hash', 'content_hash'])
+
+    reports = []
+    payloads = {}
+    for report in Report.objects.order_by().iterator(chunk_size=500):
+        snapshot = {field: getattr(report, field) for field in SNAPSHOT_FIELDS}
+        report.snapshot_hash = digest(snapshot)
+        payloads[report.snapshot_hash] = snapshot
+        if report.response_content is not None:
+            report.content_hash = digest(report.response_content)
+            payloads[report.content_hash] = report.response_content
+        reports.append(report)
+        if len(reports) >= 500:
+            flush(reports, payloads)
+            reports = []
+            payloads = {}
+    if reports:
+        flush(reports, payloads)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0022_json_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Payload',
+            fields=[
+                ('hash', models.CharField(max_length=64, primary_key=True, serialize=False, verbose_name='内容 sha256')),
+                ('content', models.JSONField(blank=True, null=True, verbose_name='内容')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+            ],
+            options={
+                'db_table': 'platform_payload',
+            },
+        ),
+        migrations.AddField(
+            model_name='report',
+            name='snapshot_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True, verbose_name='用例快照哈希'),
+        ),
+        migrations.AddField(
+            model_name='report',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True, verbose_name='响应内容哈希'),
+        ),
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+        migrations.RemoveField(model_name='report', name='remark'),
+        migrations.RemoveField(model_name='report', name='method'),
+        migrations.RemoveField(model_name='report', name='host'),
+        migrations.RemoveField(model_name='report', name='path'),
+        migrations.RemoveField(model_name='report', name='params'),
+        migrations.RemoveField(model_name='report', name='headers'),
+        migrations.RemoveField(model_name='report', name='extend_keys'),
+        migrations.RemoveField(model_name='report', name='extend_values'),
+        migrations.RemoveField(model_name='report', name='expected_keys'),
+        migrations.RemoveField(model_name='report', name='expected_values'),
+        migrations.RemoveField(model_name='report', name='expected_http_status'),
+        migrations.RemoveField(model_name='report', name='check_status'),
+        migrations.RemoveField(model_name='report', name='run'),
+        migrations.RemoveField(model_name='report', name='developer'),
+        migrations.RemoveField(model_name='report', name='project_id'),
+        migrations.RemoveField(model_name='report', name='delay'),
+        migrations.RemoveField(model_name='report', name='sample'),
+        migrations.RemoveField(model_name='report', name='response_content'),
+    ]
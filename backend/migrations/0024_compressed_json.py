@@ -0,0 +1,42 @@
+# Generated by Django 3.1.2 on 2026-10-18 18:00
+
+import backend.models
+from django.db import migrations
+
+
+def forwards(apps, schema_editor):
+    """
+    重新保存已有数据，超过阈值的内容压缩存储
+    """
+
+    for name, field in (('Payload', 'content'), ('CaseInfo', 'sample')):
+        model = apps.get_model('backend', name)
+        objs = []
+        for obj in model.objects.exclude(**{field: None}).only('pk', field).order_by().iterator(chunk_size=500):
+            objs.append(obj)
+            if len(objs) >= 500:
+                model.objects.bulk_update(objs, [field])
+                objs = []
+        if objs:
+            model.objects.bulk_update(objs, [field])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0023_report_payload'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='payload',
+            name='content',
+            field=backend.models.CompressedJSONField(blank=True, editable=True, null=True, verbose_name='内容'),
+        ),
+        migrations.AlterField(
+            model_name='caseinfo',
+            name='sample',
+            field=backend.models.CompressedJSONField(blank=True, editable=True, null=True, verbose_name='结果示例，用于接口依赖时方便直接获得取值步骤'),
+        ),
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,102 @@
+# Generated by Django 3.1.2 on 2026-10-18 20:00
+
+import math
+import django.core.validators
+from django.db import migrations, models
+
+# 迁移时的耗时直方图区间，与当时的 LATENCY_BUCKETS 一致，之后修改配置不影响本迁移
+BUCKETS = [int(10 * 1.25 ** i) for i in range(40)]
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    return values[max(1, math.ceil(p / 100 * len(values))) - 1]
+
+
+def rollup(values):
+    """
+    汇总一次执行的耗时，values 需已升序
+    """
+
+    histogram = {}
+    for value in values:
+        key = str(next((bucket for bucket in BUCKETS if bucket >= value), value))
+        histogram[key] = histogram.get(key, 0) + 1
+    return {
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'time_sum': sum(values),
+        'time_max': values[-1] if values else 0,
+        'histogram': histogram
+    }
+
+
+def forwards(apps, schema_editor):
+    """
+    为已经结束的测试记录补充执行汇总
+    """
+
+    Record = apps.get_model('backend', 'Record')
+    Report = apps.get_model('backend', 'Report')
+    RecordSummary = apps.get_model('backend', 'RecordSummary')
+    summaries = []
+    for record in Record.objects.exclude(status='RUNNING').order_by().iterator(chunk_size=500):
+        values = list(Report.objects.filter(owner=record.owner, record_id=record.id).exclude(status='IGNORED')
+                      .order_by('time_used').values_list('time_used', flat=True))
+        summaries.append(RecordSummary(owner=record.owner, record_id=record.id, group_id=record.group_id,
+                                       project_id=record.project_id, status=record.status, total=record.total,
+                                       passed=record.passed, failed=record.failed, ignored=record.ignored,
+                                       **rollup(values)))
+        if len(summaries) >= 500:
+            RecordSummary.objects.bulk_create(summaries)
+            summaries = []
+    if summaries:
+        RecordSummary.objects.bulk_create(summaries)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0024_compressed_json'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='report',
+            index=models.Index(fields=['owner', 'case_id', 'record_id'], name='report_owner_case_idx'),
+        ),
+        migrations.CreateModel(
+            name='RecordSummary',
+            fields=[
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('owner', models.IntegerField(validators=[django.core.validators.MinValueValidator(1, message='最小值为 1')], verbose_name='拥有者')),
+                ('record_id', models.IntegerField(unique=True, validators=[django.core.validators.MinValueValidator(1, message='最小值为 1')], verbose_name='记录 id')),
+                ('group_id', models.IntegerField(default=0, verbose_name='分组 id')),
+                ('project_id', models.IntegerField(validators=[django.core.validators.MinValueValidator(1, message='最小值为 1')], verbose_name='关联项目 id')),
+                ('status', models.CharField(default='FINISHED', max_length=8, verbose_name='执行状态')),
+                ('total', models.IntegerField(default=0, verbose_name='总数')),
+                ('passed', models.IntegerField(default=0, verbose_name='通过数')),
+                ('failed', models.IntegerField(default=0, verbose_name='失败数')),
+                ('ignored', models.IntegerField(default=0, verbose_name='忽略数')),
+                ('time_sum', models.BigIntegerField(default=0, verbose_name='总耗时，单位毫秒，不含忽略的用例')),
+                ('time_max', models.IntegerField(default=0, verbose_name='最大耗时')),
+                ('p50', models.IntegerField(blank=True, null=True, verbose_name='耗时 p50')),
+                ('p95', models.IntegerField(blank=True, null=True, verbose_name='耗时 p95')),
+                ('p99', models.IntegerField(blank=True, null=True, verbose_name='耗时 p99')),
+                ('histogram', models.JSONField(blank=True, null=True, verbose_name='耗时直方图，区间上限到次数')),
+            ],
+            options={
+                'db_table': 'platform_record_summary',
+                'ordering': ['-record_id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='recordsummary',
+            index=models.Index(fields=['owner', 'project_id', 'record_id'], name='summary_owner_project_idx'),
+        ),
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
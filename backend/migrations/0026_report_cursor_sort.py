@@ -0,0 +1,21 @@
+# Generated by Django 3.1.2 on 2026-10-18 22:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0025_record_summary'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='report',
+            name='report_record_updated_idx',
+        ),
+        migrations.AddIndex(
+            model_name='report',
+            index=models.Index(fields=['owner', 'record_id', 'sort', '-id'], name='report_record_sort_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.2 on 2026-10-18 23:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0026_report_cursor_sort'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='caseinfo',
+            name='snapshot_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True, verbose_name='用例快照哈希，保存用例时计算'),
+        ),
+    ]
@@ -1,12 +1,16 @@
+import json
+import zlib
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.validators import MaxLengthValidator, MaxValueValidator
 from django.core.validators import MinLengthValidator
 from django.core.validators import MinValueValidator
 from django.core.validators import EmailValidator
 from django.core.validators import RegexValidator
 from django.db import models
-from django.db.models import QuerySet
+from django.db.models import QuerySet, OuterRef, Subquery
 from django.db.models.manager import BaseManager
 from backend.exception import ErrorCode, ValidateError
+from backend.settings import COMPRESS_THRESHOLD, COMPRESS_LEVEL
 
 
 class PlatformQuerySet(QuerySet):
@@ -64,6 +68,20 @@ class PlatformQuerySet(QuerySet):
             return self.__update(operation='__gte', **kwargs)
         return self.__update(operation='__gt', **kwargs)
 
+    def join_name(self, model, field, name, column='name'):
+        """
+        附带关联数据的名称
+
+        以关联子查询的方式与主查询在同一条 SQL 中完成，关联数据不存在时为 None
+        :param model: 关联的模型
+        :param field: 当前模型中保存关联 id 的字段
+        :param name: 附带到结果上的属性名
+        :param column: 关联模型中取值的字段
+        """
+
+        related = model.objects.filter(id=OuterRef(field), owner=OuterRef('owner')).values(column)[:1]
+        return self.annotate(**{name: Subquery(related)})
+
     def __update(self, operation, **kwargs):
         """
         对字典进行更新
@@ -91,6 +109,57 @@ class PlatformManager(BaseManager.from_queryset(PlatformQuerySet)):
     pass
 
 
+class CompressedJSONField(models.BinaryField):
+    """
+    压缩存储的 JSON 字段
+
+    以二进制保存 JSON 文本，超过 COMPRESS_THRESHOLD 字节时使用 zlib 压缩
+    首字节标记存储方式，没有标记的按原始 JSON 文本解析，兼容由 JSON 列转换而来的数据
+    只在查询出该字段时才解压，不查询该字段的列表不受影响
+    序列化(dumpdata/loaddata)时与 JSONField 一致，使用未压缩的 JSON 值
+    """
+
+    RAW = b'\x00'
+    COMPRESSED = b'\x01'
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('editable', True)
+        super().__init__(*args, **kwargs)
+
+    def get_prep_value(self, value):
+        if value is None:
+            return None
+        text = json.dumps(value, ensure_ascii=False, cls=DjangoJSONEncoder).encode('utf-8')
+        if len(text) >= COMPRESS_THRESHOLD:
+            return self.COMPRESSED + zlib.compress(text, COMPRESS_LEVEL)
+        return self.RAW + text
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return None
+        return self.decode(value.encode('utf-8') if isinstance(value, str) else bytes(value))
+
+    def to_python(self, value):
+        # 存储格式的二进制需要解码，其他值已经是 JSON 值
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return self.decode(bytes(value))
+        return value
+
+    def value_to_string(self, obj):
+        return self.value_from_object(obj)
+
+    def decode(self, value):
+        """
+        将存储格式的二进制解码为 JSON 值
+        """
+
+        if value[:1] == self.COMPRESSED:
+            value = zlib.decompress(value[1:])
+        elif value[:1] == self.RAW:
+            value = value[1:]
+        return json.loads(value)
+
+
 class BaseEntity(models.Model):
     """
     统一基类
@@ -339,12 +408,14 @@ class CaseInfo(BaseEntity):
                                                validators=[MinValueValidator(1, message='最小值为 1')])
     owner = models.IntegerField(verbose_name='拥有者', validators=[MinValueValidator(1, message='最小值为 1')])
     params = models.JSONField(verbose_name='请求参数', blank=True, null=True)
-    sample = models.JSONField(verbose_name='结果示例，用于接口依赖时方便直接获得取值步骤', blank=True, null=True)
+    sample = CompressedJSONField(verbose_name='结果示例，用于接口依赖时方便直接获得取值步骤', blank=True, null=True)
+    snapshot_hash = models.CharField(verbose_name='用例快照哈希，保存用例时计算', max_length=64, blank=True, null=True,
+                                     db_index=True)
 
-    extend_keys = models.TextField(verbose_name='扩展字段', blank=True, null=True)
-    extend_values = models.TextField(verbose_name='扩展值', blank=True, null=True)
-    expected_keys = models.TextField(verbose_name='预期字段', blank=True, null=True)
-    expected_values = models.TextField(verbose_name='预期值', blank=True, null=True)
+    extend_keys = models.JSONField(verbose_name='扩展字段', blank=True, null=True)
+    extend_values = models.JSONField(verbose_name='扩展值', blank=True, null=True)
+    expected_keys = models.JSONField(verbose_name='预期字段', blank=True, null=True)
+    expected_values = models.JSONField(verbose_name='预期值', blank=True, null=True)
 
     class Meta:
         # 表名
@@ -377,6 +448,9 @@ class Record(BaseEntity):
     failed = models.IntegerField(verbose_name='失败数', default=0)
     ignored = models.IntegerField(verbose_name='忽略数', default=0)
     total = models.IntegerField(verbose_name='总数', default=0)
+    status = models.CharField(verbose_name='执行状态', max_length=8, default='FINISHED',
+                              validators=[MinLengthValidator(1, message='最小长度为 1'),
+                                          MaxLengthValidator(8, message='最大长度为 8')])
 
     class Meta:
         # 表名
@@ -386,46 +460,24 @@ class Record(BaseEntity):
         # 普通索引
         indexes = [
             models.Index(fields=['owner', 'group_id'], name='record_owner_group_idx'),
-            models.Index(fields=['owner', 'group_id', 'project_id'], name='record_owner_group_project_idx')
+            models.Index(fields=['owner', 'group_id', 'project_id'], name='record_owner_group_project_idx'),
+            # 游标分页
+            models.Index(fields=['owner', 'updated_at', 'id'], name='record_owner_updated_idx')
         ]
 
 
 class Report(BaseEntity):
     """
     测试报告
+
+    只保存执行结果，用例快照以及响应内容按内容哈希保存在 Payload 中
     """
     id = models.AutoField(primary_key=True)
     name = models.CharField(verbose_name='用例名称', max_length=32,
                             validators=[MinLengthValidator(1, message='最小长度为 1'),
                                         MaxLengthValidator(32, message='最大长度为 32')])
-    remark = models.CharField(verbose_name='用例备注', max_length=255, blank=True, null=True,
-                              validators=[MinLengthValidator(1, message='最小长度为 1'),
-                                          MaxLengthValidator(255, message='最大长度为 255')])
-    method = models.CharField(verbose_name='请求方法', max_length=8,
-                              validators=[MinLengthValidator(1, message='最小长度为 1'),
-                                          MaxLengthValidator(8, message='最大长度为 8')])
-    host = models.CharField(verbose_name='请求 host，没填会使用项目的', max_length=255, blank=True, null=True)
-    path = models.CharField(verbose_name='请求地址', max_length=255,
-                            validators=[MinLengthValidator(1, message='最小长度为 1'),
-                                        MaxLengthValidator(255, message='最大长度为 255')])
-    params = models.JSONField(verbose_name='请求参数', blank=True, null=True)
-    extend_keys = models.TextField(verbose_name='扩展字段', blank=True, null=True)
-    extend_values = models.TextField(verbose_name='扩展值', blank=True, null=True)
-    headers = models.JSONField(verbose_name='请求头', blank=True, null=True)
-    expected_keys = models.TextField(verbose_name='预期字段', blank=True, null=True)
-    expected_values = models.TextField(verbose_name='预期值', blank=True, null=True)
-    expected_http_status = models.IntegerField(verbose_name='Http 状态码', blank=True, null=True, default=200,
-                                               validators=[MinValueValidator(1, message='最小值为 1')])
-    check_status = models.BooleanField(verbose_name='是否校验 Http 状态', default=False)
-    run = models.BooleanField(verbose_name='是否运行', default=True)
     owner = models.IntegerField(verbose_name='拥有者', validators=[MinValueValidator(1, message='最小值为 1')])
-    developer = models.IntegerField(verbose_name='接口开发者', blank=True, null=True)
-    project_id = models.IntegerField(verbose_name='关联项目 id', validators=[MinValueValidator(1, message='最小值为 1')])
     sort = models.IntegerField(verbose_name='接口排序', default=0, validators=[MinValueValidator(1, message='最小值为 1')])
-    delay = models.IntegerField(verbose_name='延迟执行时长, 单位秒, 最长延时五分钟即 300', default=0,
-                                validators=[MinValueValidator(0, message='最小值为 0'),
-                                            MaxValueValidator(300, message='最大值为 300')])
-    sample = models.JSONField(verbose_name='结果示例，用于接口依赖时方便直接获得取值步骤', blank=True, null=True)
     case_id = models.IntegerField(verbose_name='等同于用例 id', default=0,
                                   validators=[MinValueValidator(1, message='最小值为 1')])
     response_code = models.CharField(verbose_name='响应状态', max_length=8, blank=True, null=True,
@@ -433,12 +485,13 @@ class Report(BaseEntity):
                                                  MaxLengthValidator(8, message='最大长度为 8')])
     http_status = models.IntegerField(verbose_name='Http 状态码', default=200,
                                       validators=[MinValueValidator(1, message='最小值为 1')])
-    response_content = models.JSONField(verbose_name='响应状态', blank=True, null=True)
     time_used = models.IntegerField(verbose_name='请求耗时', default=0)
     record_id = models.IntegerField(verbose_name='记录 id', validators=[MinValueValidator(1, message='最小值为 1')])
     status = models.CharField(verbose_name='用例执行结果', max_length=8, default='FAILED',
                               validators=[MinLengthValidator(1, message='最小长度为 1'),
                                           MaxLengthValidator(8, message='最大长度为 8')])
+    snapshot_hash = models.CharField(verbose_name='用例快照哈希', max_length=64, blank=True, null=True, db_index=True)
+    content_hash = models.CharField(verbose_name='响应内容哈希', max_length=64, blank=True, null=True, db_index=True)
 
     class Meta:
         # 表名
@@ -447,5 +500,59 @@ class Report(BaseEntity):
         ordering = ['sort', '-updated_at']
         # 普通索引
         indexes = [
-            models.Index(fields=['owner', 'record_id'], name='report_owner_record_idx')
+            models.Index(fields=['owner', 'record_id'], name='report_owner_record_idx'),
+            # 游标分页
+            models.Index(fields=['owner', 'record_id', 'sort', '-id'], name='report_record_sort_idx'),
+            # 用例趋势
+            models.Index(fields=['owner', 'case_id', 'record_id'], name='report_owner_case_idx')
+        ]
+
+
+class RecordSummary(BaseEntity):
+    """
+    测试记录的执行汇总
+
+    执行结束时根据用例报告汇总一次，项目趋势只查询汇总，不再扫描用例报告
+    """
+    id = models.AutoField(primary_key=True)
+    owner = models.IntegerField(verbose_name='拥有者', validators=[MinValueValidator(1, message='最小值为 1')])
+    record_id = models.IntegerField(verbose_name='记录 id', unique=True,
+                                    validators=[MinValueValidator(1, message='最小值为 1')])
+    group_id = models.IntegerField(verbose_name='分组 id', default=0)
+    project_id = models.IntegerField(verbose_name='关联项目 id', validators=[MinValueValidator(1, message='最小值为 1')])
+    status = models.CharField(verbose_name='执行状态', max_length=8, default='FINISHED')
+    total = models.IntegerField(verbose_name='总数', default=0)
+    passed = models.IntegerField(verbose_name='通过数', default=0)
+    failed = models.IntegerField(verbose_name='失败数', default=0)
+    ignored = models.IntegerField(verbose_name='忽略数', default=0)
+    time_sum = models.BigIntegerField(verbose_name='总耗时，单位毫秒，不含忽略的用例', default=0)
+    time_max = models.IntegerField(verbose_name='最大耗时', default=0)
+    p50 = models.IntegerField(verbose_name='耗时 p50', blank=True, null=True)
+    p95 = models.IntegerField(verbose_name='耗时 p95', blank=True, null=True)
+    p99 = models.IntegerField(verbose_name='耗时 p99', blank=True, null=True)
+    histogram = models.JSONField(verbose_name='耗时直方图，区间上限到次数', blank=True, null=True)
+
+    class Meta:
+        # 表名
+        db_table = 'platform_record_summary'
+        # 排序
+        ordering = ['-record_id']
+        # 普通索引
+        indexes = [
+            models.Index(fields=['owner', 'project_id', 'record_id'], name='summary_owner_project_idx')
         ]
+
+
+class Payload(models.Model):
+    """
+    测试报告的内容
+
+    按内容的 sha256 寻址，相同的用例快照、响应内容只保存一份，多次执行之间共享
+    """
+    hash = models.CharField(verbose_name='内容 sha256', max_length=64, primary_key=True)
+    content = CompressedJSONField(verbose_name='内容', blank=True, null=True)
+    created_at = models.DateTimeField(verbose_name='创建时间', auto_now_add=True)
+
+    class Meta:
+        # 表名
+        db_table = 'platform_payload'
@@ -4,3 +4,88 @@ FORM_DATA = 'multipart/form-data'
 IGNORED = 'IGNORED'
 PASSED = 'PASSED'
 FAILED = 'FAILED'
+# 项目执行时默认的并发数，默认按 sort 顺序逐个执行，传入 workers 时才并发执行
+EXECUTE_WORKERS = 1
+# 执行引擎，线程池或者事件循环
+THREAD_ENGINE = 'thread'
+ASYNC_ENGINE = 'async'
+# 异步执行引擎默认的并发数
+ASYNC_EXECUTE_WORKERS = 200
+# 用例请求建立连接失败时的重试次数
+HTTP_RETRIES = 1
+# 记录执行状态
+RUNNING = 'RUNNING'
+FINISHED = 'FINISHED'
+ERROR = 'ERROR'
+# 后台执行任务的并发数
+JOB_WORKERS = 4
+# 执行进度缓存时长
+JOB_PROGRESS_TIMEOUT = 24 * 60 * 60
+# 执行进度写入缓存的最小间隔，单位秒
+JOB_PROGRESS_INTERVAL = 1
+# 执行中记录的心跳间隔，单位秒
+JOB_HEARTBEAT_INTERVAL = 15
+# 超过该秒数没有心跳的执行中记录视为执行进程已退出
+JOB_HEARTBEAT_TIMEOUT = 60
+# 检查已中断的执行中记录的间隔，单位秒
+JOB_SWEEP_INTERVAL = 5 * 60
+# 用例报告批量写入的批次大小
+REPORT_BATCH_SIZE = 100
+# 批量执行项目时同时执行的项目数
+BATCH_WORKERS = 4
+# 批量执行项目时对同一个 host 同时进行中的请求数
+BATCH_HOST_LIMIT = 16
+# 响应内容分块读取的块大小
+RESPONSE_CHUNK_SIZE = 64 * 1024
+# 响应内容完整保存的最大字节数，超过后只保留需要用到的字段，只限制保存的内容，解析时仍读取完整响应
+RESPONSE_CAPTURE_SIZE = 1024 * 1024
+# 响应内容读取的最大字节数，超过后放弃读取
+RESPONSE_MAX_SIZE = 50 * 1024 * 1024
+# 响应内容被截断的标记
+TRUNCATED = '_truncated'
+# 导出文件在内存中缓冲的最大字节数，超过后转存临时文件
+EXPORT_SPOOL_SIZE = 10 * 1024 * 1024
+# 导出时每批从数据库读取的行数
+EXPORT_CHUNK_SIZE = 2000
+# Excel 单元格最大字符数
+EXCEL_CELL_MAX_LENGTH = 32767
+# 登录 token 有效期，单位秒
+TOKEN_TIMEOUT = 60 * 60 * 24 * 7
+# 刷新 token 过期时间的最小间隔，单位秒
+TOKEN_REFRESH_INTERVAL = 60 * 60
+# 进程内认证缓存的最大条数
+AUTH_CACHE_SIZE = 1024
+# 进程内认证缓存的有效期，单位秒，决定了多进程部署时登出、更换密钥生效的最长延迟
+AUTH_CACHE_TIMEOUT = 60
+# 不需要登录的请求路径正则，使用 match 从路径开头匹配
+AUTH_IGNORES = [r'^/$', r'/user/signin']
+# 是否在日志中记录每个请求的认证耗时以及总耗时
+REQUEST_TIMING_LOG = False
+# 请求耗时直方图的区间，单位秒
+METRICS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+# 指标接口的抓取 token，配置后可使用请求头 Authorization: Bearer <token> 访问，不配置时需要登录
+METRICS_TOKEN = None
+# 请求性能分析的采样率，0 为关闭
+PROFILE_SAMPLE_RATE = 0
+# 采样的请求耗时超过该秒数时保存性能分析结果
+PROFILE_SLOW_THRESHOLD = 1
+# 游标分页时总数的缓存时长，单位秒
+PAGE_COUNT_TIMEOUT = 60
+# 注入、预期相关的 JSON 字段
+JSON_FIELDS = ['extend_keys', 'extend_values', 'expected_keys', 'expected_values']
+# 测试报告中保存的用例快照字段
+SNAPSHOT_FIELDS = ['remark', 'method', 'host', 'path', 'params', 'headers', 'extend_keys', 'extend_values',
+                   'expected_keys', 'expected_values', 'expected_http_status', 'check_status', 'run', 'developer',
+                   'project_id', 'delay', 'sample']
+# 压缩存储的 JSON 字段超过该字节数时压缩
+COMPRESS_THRESHOLD = 1024
+# zlib 压缩级别
+COMPRESS_LEVEL = 6
+# 首页统计计数的缓存时长，单位秒
+STATISTICS_TIMEOUT = 60 * 60
+# 趋势分析默认的执行次数窗口
+ANALYTICS_WINDOW = 30
+# 趋势分析最大的执行次数窗口
+ANALYTICS_MAX_WINDOW = 500
+# 执行汇总中耗时直方图的区间上限，单位毫秒，从 10 毫秒按 1.25 倍递增到约 1 分钟
+LATENCY_BUCKETS = [int(10 * 1.25 ** i) for i in range(40)]
@@ -0,0 +1,246 @@
+import json
+import os
+import tempfile
+import uuid
+from types import SimpleNamespace
+from unittest import mock
+from openpyxl import Workbook
+from django.core import serializers
+from django.test import SimpleTestCase, TestCase, RequestFactory
+from backend.exception import PlatformError
+from backend.handler.case.case_info import CaseInfoViewSet, bulk_create_cases, save_case
+from backend.handler.project.project import ProjectViewSet, import_sheets
+from backend.handler.record import report
+from backend.handler.record.record import RecordViewSet
+from backend.handler.record.report import ReportViewSet
+from backend.models import CaseInfo, Contactor, Payload, Project, ProjectGroup, Record, Report
+from backend.settings import FINISHED, TRUNCATED
+from backend.util import UserHolder, Executor
+from backend.util.execute import JsonPath
+from backend.util.job import ImportProgress
+
+OWNER = 1
+# 每个列表的数据条数，查询次数不能随条数增长
+SIZE = 5
+
+
+class ListQueryCountTest(TestCase):
+    """
+    列表接口的查询次数
+
+    关联的名称在列表查询中一次取回，不能退化为逐条查询
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.project = None
+        for i in range(SIZE):
+            group = ProjectGroup.objects.create(name='group' + str(i), owner=OWNER)
+            project = Project.objects.create(name='project' + str(i), remark='remark', owner=OWNER,
+                                             group_id=group.id)
+            developer = Contactor.objects.create(name='developer' + str(i), email='dev%d@test.com' % i,
+                                                 phone='1380000000' + str(i), owner=OWNER)
+            record = Record.objects.create(group_id=group.id, project_id=project.id, owner=OWNER, total=SIZE)
+            for j in range(SIZE):
+                Report.objects.create(name='report' + str(j), owner=OWNER, case_id=j + 1, record_id=record.id)
+            cls.project = cls.project or project
+            cls.record = record
+            CaseInfo.objects.create(name='case' + str(i), method='GET', path='/path', project_id=cls.project.id,
+                                    developer=developer.id, owner=OWNER, sample={'code': 0})
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        UserHolder.cache_user(OWNER)
+
+    def get(self, view_set, path, data):
+        response = view_set.as_view({'get': 'list'})(self.factory.get(path, data))
+        return json.loads(response.content)['data']
+
+    def test_project_list(self):
+        with self.assertNumQueries(2):
+            data = self.get(ProjectViewSet, '/project/', {'page_size': SIZE})
+        self.assertEqual(len(data['records']), SIZE)
+        self.assertTrue(all(o['group_name'] for o in data['records']))
+
+    def test_record_list(self):
+        with self.assertNumQueries(2):
+            data = self.get(RecordViewSet, '/record/', {'page_size': SIZE})
+        self.assertEqual(len(data['records']), SIZE)
+        self.assertTrue(all(o['group_name'] and o['project_name'] for o in data['records']))
+
+    def test_report_list(self):
+        with self.assertNumQueries(2):
+            data = self.get(ReportViewSet, '/report/', {'record_id': self.record.id, 'page_size': SIZE})
+        self.assertEqual(len(data['records']), SIZE)
+
+    def test_case_list(self):
+        # 项目、总数、分页各一次
+        with self.assertNumQueries(3):
+            data = self.get(CaseInfoViewSet, '/case/', {'project_id': self.project.id, 'page_size': SIZE})
+        self.assertEqual(len(data['records']), SIZE)
+        self.assertTrue(all(o['developer_name'] for o in data['records']))
+        # 结果示例只在详情中返回
+        self.assertTrue(all('sample' not in o for o in data['records']))
+
+
+class ImportSheetsTest(TestCase):
+    """
+    多进程导入旧版 Excel
+
+    子进程以 spawn 方式启动，只初始化 Django 后解析 sheet 页，不能因循环导入失败
+    """
+
+    TITLES = ['description', 'step', 'run', 'method', 'host', 'path', 'sleep', 'params', 'ex_keys', 'ex_values',
+              'headers', 'expected_key', 'expected_value', 'check_step', 'response_content']
+
+    def setUp(self):
+        UserHolder.cache_user(OWNER)
+        group = ProjectGroup.objects.create(name='group', owner=OWNER)
+        self.project = Project.objects.create(name='project', remark='remark', owner=OWNER, group_id=group.id)
+
+    def build_workbook(self, sheets, size):
+        fd, file_path = tempfile.mkstemp(suffix='.xlsx')
+        os.close(fd)
+        work_book = Workbook()
+        work_book.remove(work_book.active)
+        for i in range(sheets):
+            sheet = work_book.create_sheet('sheet' + str(i))
+            sheet.append(['登录'])
+            sheet.append(['host', 'http://localhost'])
+            sheet.append(['params', None])
+            sheet.append(['default', 'http://localhost'])
+            sheet.append(self.TITLES)
+            for j in range(size):
+                sheet.append(['', 'case%d-%d' % (i, j), None, 'get', None, '/path', None, None, None, None, None,
+                              'code', 0, 'code', None])
+        work_book.save(file_path)
+        return file_path
+
+    def test_import_with_processes(self):
+        file_path = self.build_workbook(3, 4)
+        sheet_names = ['sheet0', 'sheet1', 'sheet2']
+        progress = ImportProgress(uuid.uuid4().hex, len(sheet_names))
+        import_sheets(self.project, file_path, sheet_names, progress, processes=2)
+        self.assertEqual(ImportProgress.get(progress.job_id)['status'], FINISHED)
+        names = list(CaseInfo.objects.filter(project_id=self.project.id).order_by('sort').values_list('name', flat=True))
+        self.assertEqual(names, ['case%d-%d' % (i, j) for i in range(3) for j in range(4)])
+        self.assertFalse(os.path.exists(file_path))
+
+
+class BulkCreateCasesTest(TestCase):
+    """
+    批量创建用例的查询次数
+
+    用例名称的唯一性一次查询完成校验，查询次数不能随用例数增长
+    """
+
+    def setUp(self):
+        UserHolder.cache_user(OWNER)
+        group = ProjectGroup.objects.create(name='group', owner=OWNER)
+        self.project = Project.objects.create(name='project', remark='remark', owner=OWNER, group_id=group.id)
+
+    def build_cases(self, prefix, size):
+        return [CaseInfo(name=prefix + str(i), method='get', path='/' + prefix, project_id=self.project.id,
+                         owner=OWNER) for i in range(size)]
+
+    def test_query_count(self):
+        # 保存点、项目、最大排序、已有名称、已有快照、插入快照、插入用例、释放保存点
+        for prefix, size in [('small', 2), ('large', 40)]:
+            with self.assertNumQueries(8):
+                bulk_create_cases(self.build_cases(prefix, size))
+        self.assertEqual(CaseInfo.objects.filter(project_id=self.project.id).count(), 42)
+
+    def test_duplicate_name(self):
+        cases = self.build_cases('case', 2)
+        cases[1].name = cases[0].name
+        self.assertRaises(PlatformError, bulk_create_cases, cases)
+        bulk_create_cases(self.build_cases('case', 2))
+        self.assertRaises(PlatformError, bulk_create_cases, self.build_cases('case', 1))
+        self.assertEqual(CaseInfo.objects.filter(project_id=self.project.id).count(), 2)
+
+
+class JsonPathTest(SimpleTestCase):
+    """
+    按取值步骤设值
+
+    中间不存在的层级按下一步创建，下一步是数字时创建数组
+    """
+
+    def test_set_array_path(self):
+        target = {}
+        JsonPath(['data', '1', 'id']).set(2, target)
+        JsonPath(['data', '0', 'id']).set(1, target)
+        JsonPath(['data', '1', 'tags', '1']).set('b', target)
+        self.assertEqual(target, {'data': [{'id': 1}, {'id': 2, 'tags': [None, 'b']}]})
+        self.assertEqual(JsonPath(['data', '1', 'tags', '1']).get(target), 'b')
+
+    def test_set_top_level_array(self):
+        target = []
+        JsonPath(['1', 'id']).set(1, target)
+        self.assertEqual(target, [None, {'id': 1}])
+
+
+class ParseBodyTest(SimpleTestCase):
+    """
+    响应内容超过采集大小时的截断
+    """
+
+    def setUp(self):
+        self.executor = Executor([], None)
+        self.case_info = SimpleNamespace(id=1)
+        self.executor.captures = {1: [JsonPath(['code']), JsonPath(['data', '1', 'id'])]}
+
+    def parse(self, source):
+        body = json.dumps(source).encode('utf-8')
+        with mock.patch('backend.util.execute.RESPONSE_CAPTURE_SIZE', 10):
+            return self.executor._Executor__parse_body(body, self.case_info), len(body)
+
+    def test_capture_array_path(self):
+        result, size = self.parse({'code': 0, 'data': [{'id': 1, 'name': 'a'}, {'id': 2, 'name': 'b'}]})
+        self.assertEqual(result, {TRUNCATED: True, 'size': size, 'code': 0, 'data': [None, {'id': 2}]})
+
+    def test_truncate_top_level_array(self):
+        result, size = self.parse([{'id': i} for i in range(10)])
+        self.assertEqual(result, {TRUNCATED: True, 'size': size})
+
+
+class CaseSnapshotTest(TestCase):
+    """
+    压缩存储的结果示例以及用例快照
+
+    序列化时使用未压缩的 JSON 值，用例快照在保存用例时计算
+    """
+
+    def setUp(self):
+        UserHolder.cache_user(OWNER)
+        group = ProjectGroup.objects.create(name='group', owner=OWNER)
+        self.project = Project.objects.create(name='project', remark='remark', owner=OWNER, group_id=group.id)
+        # 超过压缩阈值的结果示例
+        self.sample = {'code': 0, 'data': [{'id': i, 'name': 'name' + str(i)} for i in range(100)]}
+
+    def build_case(self):
+        case = CaseInfo(name='case', method='get', path='/path', project_id=self.project.id, owner=OWNER, sort=1,
+                        sample=self.sample)
+        save_case(case)
+        return case
+
+    def test_serialize(self):
+        self.build_case()
+        data = serializers.serialize('json', CaseInfo.objects.all())
+        self.assertEqual(json.loads(data)[0]['fields']['sample'], self.sample)
+        CaseInfo.objects.all().delete()
+        for obj in serializers.deserialize('json', data):
+            obj.save()
+        self.assertEqual(CaseInfo.objects.get().sample, self.sample)
+
+    def test_snapshot(self):
+        case = self.build_case()
+        self.assertEqual(Payload.objects.get(hash=case.snapshot_hash).content['sample'], self.sample)
+        old_hash = case.snapshot_hash
+        case.path = '/other'
+        save_case(case)
+        self.assertNotEqual(case.snapshot_hash, old_hash)
+        # 被用例引用的快照不会被清理
+        report.delete_payloads([old_hash, case.snapshot_hash])
+        self.assertFalse(Payload.objects.filter(hash=old_hash).exists())
+        self.assertTrue(Payload.objects.filter(hash=case.snapshot_hash).exists())
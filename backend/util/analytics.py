@@ -0,0 +1,101 @@
+import bisect
+import math
+from backend.settings import PASSED, IGNORED, LATENCY_BUCKETS
+
+
+def percentile(values, p):
+    """
+    按最近秩法计算百分位，values 需已升序
+    """
+
+    if not values:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(values)))
+    return values[rank - 1]
+
+
+def bucket(value):
+    """
+    耗时所在区间的上限，超出最大区间时取耗时本身
+    """
+
+    index = bisect.bisect_left(LATENCY_BUCKETS, value)
+    return LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else value
+
+
+def histogram(values):
+    """
+    统计耗时直方图，区间上限到次数的映射，只保存非空区间
+    """
+
+    result = {}
+    for value in values:
+        key = str(bucket(value))
+        result[key] = result.get(key, 0) + 1
+    return result
+
+
+def merge(histograms):
+    """
+    合并多次执行的耗时直方图
+    """
+
+    result = {}
+    for item in histograms:
+        for key, count in (item or {}).items():
+            result[key] = result.get(key, 0) + count
+    return result
+
+
+def histogram_percentile(histogram, p):
+    """
+    根据直方图估算百分位，返回所在区间的上限
+    """
+
+    total = sum(histogram.values())
+    if not total:
+        return None
+    rank = max(1, math.ceil(p / 100 * total))
+    cumulative = 0
+    for key in sorted(histogram, key=int):
+        cumulative += histogram[key]
+        if cumulative >= rank:
+            return int(key)
+
+
+def rollup(values):
+    """
+    汇总一次执行的耗时，values 需已升序
+    """
+
+    return {
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'time_sum': sum(values),
+        'time_max': values[-1] if values else 0,
+        'histogram': histogram(values)
+    }
+
+
+def pass_rate(passed, failed):
+    """
+    通过率，忽略的用例不参与计算
+    """
+
+    decided = passed + failed
+    return round(passed / decided, 4) if decided else None
+
+
+def flakiness(statuses):
+    """
+    不稳定度
+
+    按执行先后排列的结果中，相邻两次在通过、失败之间翻转的比例，忽略的执行不参与
+    """
+
+    statuses = [status == PASSED for status in statuses if status != IGNORED]
+    if len(statuses) < 2:
+        return 0
+    flips = len([1 for previous, current in zip(statuses, statuses[1:]) if previous != current])
+    return round(flips / (len(statuses) - 1), 4)
@@ -1,85 +1,123 @@
+import asyncio
 import json
 import re
+import threading
 import time
+from contextlib import nullcontext
 import requests
+from django.db import connection
 from requests import Response
 from backend.models import Report
-from backend.util import filter_obj_single, PlatformError, ErrorCode
-from backend.handler.file import file
+from backend.util import PlatformError, ErrorCode, UserHolder
+from backend.util.scheduler import CaseScheduler
+from backend.util.http_session import SessionPool
 from backend.settings import *
 
 
-def get_value(source, steps):
+def compile_step(step):
     """
-    根据入参字典以及取值步骤取出结果
+    预处理单个取值步骤，数字字符串转为 int(数字代表从列表取值)
+    """
+
+    return int(step) if isinstance(step, str) and step.isdigit() else step
+
 
-    steps 为取值步骤组成的列表
+class JsonPath:
     """
-    try:
-        # 循环取值步骤列表
-        for step in steps:
-            # 如果为数字则转为数字(数字代表从列表取值)，否则为字符
-            step = step if not step.isdigit() else int(step)
-            # 如果 step 是数字，则是从 list 中取值
-            if isinstance(step, int) and isinstance(source, list) and len(source) < 1:
-                return None
-            # 从结果字典取值
-            source = source[step]
-    # 出现异常直接填充为空字符
-    except KeyError:
-        return None
-    return source
+    预编译的取值步骤
 
+    步骤在创建时一次性转为元组，执行过程中取值、设值不再解析字符串
+    """
 
-def set_value(value, target, steps):
-    copy = target
-    # 循环找到对应位置插入
-    for i in range(0, len(steps)):
-        step = steps[i]
-        # 如果当前步骤为字符串类型的数字，转为 int
-        step = step if not step.isdigit() else int(step)
-        # 取到最后了，直接将值插入该位置
-        if i == len(steps) - 1:
-            # 最后一位是数字，认为是数组
-            if isinstance(step, int):
-                # 目标数组存在
-                if isinstance(target, list):
-                    # 指定索引不存在
-                    if len(target) - 1 < step:
-                        __fill_arr(target, step, value)
-                    # 指定索引存在，替换索引位置的值
-                    else:
-                        target[step] = value
-                # 目标数组不存在
+    __slots__ = ('steps',)
+
+    def __init__(self, steps):
+        self.steps = tuple(compile_step(step) for step in steps)
+
+    def get(self, source):
+        """
+        从 source 中按取值步骤取出结果，取不到返回 None
+        """
+
+        try:
+            for step in self.steps:
+                # 如果 step 是数字，则是从 list 中取值
+                if step.__class__ is int and isinstance(source, list) and not source:
+                    return None
+                source = source[step]
+        # 出现异常直接填充为空
+        except KeyError:
+            return None
+        return source
+
+    def set(self, value, target):
+        """
+        按取值步骤将 value 插入 target 中，中间不存在的层级会自动创建
+        """
+
+        steps = self.steps
+        if not steps:
+            return
+        # 最后一步的上一级容器，以及上一级容器在其父容器中的位置
+        holder = None
+        holder_step = None
+        for i, step in enumerate(steps[:-1]):
+            try:
+                child = target[step]
+            except (KeyError, IndexError):
+                child = None
+            # 不存在的层级(包括数组中填充的空位)按下一步创建，下一步是数字时创建数组
+            if child is None:
+                child = [] if steps[i + 1].__class__ is int else {}
+                if isinstance(target, list) and len(target) <= step:
+                    _fill_arr(target, step, child)
                 else:
-                    # 创建空数组
-                    target = []
-                    __fill_arr(target, step, value)
-                    steps.pop()
-                    set_value(target, copy, steps)
+                    target[step] = child
+            holder, holder_step, target = target, step, child
+        step = steps[-1]
+        # 最后一位不是数字，直接插入
+        if step.__class__ is not int:
+            target[step] = value
+        # 最后一位是数字，且目标数组存在
+        elif isinstance(target, list):
+            # 指定索引不存在
+            if len(target) - 1 < step:
+                _fill_arr(target, step, value)
+            # 指定索引存在，替换索引位置的值
             else:
                 target[step] = value
-        # 否则继续往下找插入位置
-        else:
-            try:
-                # 从目标中取当前 key 对应的值为下一次的目标
-                target = target[step]
-            except KeyError:
-                # 报错则处理下一次可能的情况
-                if isinstance(step, int):
-                    target = []
-                    for j in range(step):
-                        target.append({})
-                else:
-                    target.update({step: {}})
-                target = target[step]
+        # 目标数组不存在，创建数组替换原有位置的值
+        elif holder is not None:
+            arr = []
+            _fill_arr(arr, step, value)
+            holder[holder_step] = arr
 
 
-def __fill_arr(arr, index, value):
+def get_value(source, steps):
+    """
+    根据入参字典以及取值步骤取出结果
+
+    steps 为取值步骤组成的列表，频繁调用时应预先创建 JsonPath
+    """
+
+    return JsonPath(steps).get(source)
+
+
+def set_value(value, target, steps):
+    """
+    根据取值步骤将值插入目标中
+
+    steps 为取值步骤组成的列表，频繁调用时应预先创建 JsonPath
+    """
+
+    JsonPath(steps).set(value, target)
+
+
+def _fill_arr(arr, index, value):
     # 从最大索引填充到指定索引
     for i in range(len(arr), index + 1):
         # 指定索引填充指定值
-        if i is index:
+        if i == index:
             arr.append(value)
         # 非指定索引填充空
         else:
@@ -94,33 +132,167 @@ class Process:
 
 class Executor:
 
-    def __init__(self, case_infos, project):
+    def __init__(self, case_infos, project, workers=None, engine=THREAD_ENGINE, pool_size=None, listener=None,
+                 release=False, limiter=None):
         self.case_infos = case_infos
         self.project = project
+        # 按 host 限制并发的限流器，可以在多次执行之间共享
+        self.limiter = limiter
+        # 单个用例执行完成后的回调，入参为用例报告
+        self.listener = listener
+        # 是否释放不再被依赖的用例的响应内容，报告由 listener 持久化时使用，降低内存占用
+        self.release = release
+        self.lock = threading.Lock()
+        # 用例依赖的用例、尚未执行完成的依赖方数量以及已完成的用例，释放响应内容时使用
+        self.depends = {}
+        self.remaining = {}
+        self.completed = set()
+        self.engine = engine if engine else THREAD_ENGINE
+        # 没有指定并发数时按执行引擎取默认值
+        if not workers:
+            workers = ASYNC_EXECUTE_WORKERS if self.engine == ASYNC_ENGINE else EXECUTE_WORKERS
+        self.workers = int(workers)
+        # 每个 host 的连接池大小，默认与并发数一致
+        self.pool_size = int(pool_size) if pool_size else self.workers
+        self.sessions = None
+        # 工作线程中没有当前用户，需要从发起执行的线程中带过去
+        self.owner = UserHolder.current_user()
         self.reports = []
+        # 以用例 id 为键的结果索引，依赖取值时直接定位
+        self.report_index = {}
         for case_info in case_infos:
-            try:
-                from backend.handler.case.case_info import decoding
-            except ImportError:
-                raise PlatformError.error(ErrorCode.FAIL)
-            decoding(case_info)
             report = Report()
             report.__dict__ = case_info.__dict__.copy()
             report.id = None
             report.case_id = case_info.id
             self.reports.append(report)
+            self.report_index[case_info.id] = report
+        # 预编译每个用例的注入以及预期的取值步骤
+        self.extends = {}
+        self.expects = {}
+        for case_info in self.case_infos:
+            self.__compile(case_info)
+        # 每个用例的响应中会被用到的取值步骤，响应内容过大时只保留这些字段
+        self.captures = self.__parse_captures()
+
+    def __compile(self, case_info):
+        """
+        预编译用例的注入以及预期
+
+        注入：(注入字段路径, 依赖用例 id, 取值路径)
+        预期：(预期字段, 依赖用例 id, 取值路径, 预期值)
+        """
+
+        extends = []
+        if case_info.extend_keys:
+            for key, p in zip(case_info.extend_keys, case_info.extend_values):
+                process = Process()
+                process.__dict__.update(p)
+                depend = int(process.depend) if process.depend is not None else None
+                extends.append((JsonPath(key), depend, JsonPath(process.steps)))
+        self.extends[case_info.id] = extends
+        expects = []
+        if case_info.expected_keys and case_info.expected_values:
+            for key, p in zip(case_info.expected_keys, case_info.expected_values):
+                steps = JsonPath([ste['value'] for ste in p['steps']])
+                # 是否存在接口依赖
+                depend = p['depend'] if 'depend' in p and isinstance(p['depend'], int) else None
+                expects.append((key[0], depend, steps, p.get('value')))
+        self.expects[case_info.id] = expects
+
+    def __parse_captures(self):
+        """
+        解析每个用例的响应中会被用到的取值步骤
+
+        包括 code、当前用例预期的取值步骤以及其他用例依赖当前用例时的取值步骤
+        """
+
+        captures = {case_id: [JsonPath(['code'])] for case_id in self.extends}
+        for case_id, extends in self.extends.items():
+            for _, depend, steps in extends:
+                if depend is not None:
+                    captures.setdefault(depend, []).append(steps)
+        for case_id, expects in self.expects.items():
+            for _, depend, steps, _ in expects:
+                captures[case_id].append(steps)
+                if depend is not None:
+                    captures.setdefault(depend, []).append(steps)
+        return captures
 
     def execute(self):
         """
         执行用例
         """
 
-        # 循环执行用例
+        # 按依赖关系并发执行用例
         if self.case_infos:
-            for case_info in self.case_infos:
-                self.__do_execute(case_info)
+            scheduler = CaseScheduler(self.case_infos, self.workers)
+            self.depends = scheduler.depends
+            self.remaining = {case_id: len(dependents) for case_id, dependents in scheduler.dependents.items()}
+            if self.engine == ASYNC_ENGINE:
+                asyncio.run(self.__execute_async(scheduler))
+            else:
+                self.sessions = SessionPool(pool_size=self.pool_size, retries=HTTP_RETRIES)
+                try:
+                    scheduler.run(self.__run_case)
+                finally:
+                    # 执行结束关闭所有连接
+                    self.sessions.close()
         return self.reports
 
+    def __run_case(self, case_info):
+        """
+        执行单个用例并通知执行完成
+        """
+
+        self.__in_worker(self.__execute_and_notify, case_info)
+
+    def __execute_and_notify(self, case_info):
+        """
+        执行单个用例，完成后通知
+        """
+
+        self.__do_execute(case_info)
+        self.__notify(case_info)
+
+    def __notify(self, case_info):
+        """
+        通知单个用例执行完成
+        """
+
+        if self.listener:
+            self.listener(self.report_index.get(case_info.id))
+        if self.release:
+            self.__release(case_info.id)
+
+    def __release(self, case_id):
+        """
+        释放不再被依赖的用例的响应内容
+
+        用例自身执行完成，且依赖它的用例也全部执行完成后，响应内容不会再被使用
+        """
+
+        with self.lock:
+            self.completed.add(case_id)
+            depends = self.depends.get(case_id, ())
+            for depend in depends:
+                self.remaining[depend] -= 1
+            for candidate in (case_id, *depends):
+                if candidate in self.completed and self.remaining.get(candidate, 0) == 0:
+                    self.report_index[candidate].response_content = None
+
+    def __in_worker(self, func, case_info):
+        """
+        在工作线程中处理单个用例
+        """
+
+        UserHolder.cache_user(self.owner)
+        try:
+            return func(case_info)
+        finally:
+            # 工作线程中打开的数据库连接需要手动关闭
+            connection.close()
+
     def __do_execute(self, case_info):
         """
         执行请求
@@ -130,8 +302,30 @@ class Executor:
         3. 填充报告
         """
 
+        prepared = self.__prepare(case_info)
+        if prepared is None:
+            return
+        report, (url, headers, params, files, result) = prepared
+        # 延时由调度器处理，到这里时已经延时完成
+        with self.limiter.hold(url) if self.limiter else nullcontext():
+            # 请求开始时间
+            start = time.time()
+            # 请求
+            result = self.__do_request(url, headers, params, files, result, case_info)
+            # 计算请求耗时
+            time_used = int((time.time() - start) * 1000)
+        # 校验结果
+        self.__check_status(report, result, time_used)
+
+    def __prepare(self, case_info):
+        """
+        执行请求前的准备
+
+        不执行的用例直接填充报告并返回 None，否则返回报告以及构建好的请求内容
+        """
+
         # 过滤出结果
-        report = filter_obj_single(self.reports, 'case_id', case_info.id)
+        report = self.report_index.get(case_info.id)
         # 如果为空则添加一个结果
         if report is None:
             raise PlatformError.error(ErrorCode.CASE_CREATE_REPORT_FAILED)
@@ -142,24 +336,63 @@ class Executor:
             report.response_content = {}
             report.http_status = 0
             report.response_code = 0
-            return
+            return None
 
         # 构建请求参数
         request = self.__build_request(case_info)
-        if request:
-            url, headers, params, files, result = request
-        else:
+        if not request:
+            return None
+        return report, request
+
+    async def __execute_async(self, scheduler):
+        """
+        使用事件循环以及异步 HTTP 客户端执行用例
+        """
+
+        try:
+            import aiohttp
+        except ImportError:
+            raise PlatformError.error(ErrorCode.ASYNC_ENGINE_UNAVAILABLE)
+        connector = aiohttp.TCPConnector(limit=self.workers, limit_per_host=self.pool_size)
+        # 会话只用于复用连接，不保存 cookie，避免不相关的用例之间共享状态
+        async with aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.DummyCookieJar()) as session:
+            await scheduler.run_async(lambda case_info: self.__run_case_async(session, case_info))
+
+    async def __run_case_async(self, session, case_info):
+        """
+        异步执行单个用例并通知执行完成
+        """
+
+        await self.__do_execute_async(session, case_info)
+        # 回调中可能会操作数据库，放到线程池中处理
+        await asyncio.get_running_loop().run_in_executor(None, self.__in_worker, self.__notify, case_info)
+
+    async def __do_execute_async(self, session, case_info):
+        """
+        异步执行请求
+
+        构建请求可能会查询数据库，放到线程池中处理，避免阻塞事件循环
+        """
+
+        loop = asyncio.get_running_loop()
+        prepared = await loop.run_in_executor(None, self.__in_worker, self.__prepare, case_info)
+        if prepared is None:
             return
-        # 是否延时请求
-        delay = case_info.delay
-        if delay and delay > 0:
-            time.sleep(delay)
-        # 请求开始时间
-        start = time.time()
-        # 请求
-        result = self.__do_request(url, headers, params, files, result, case_info)
-        # 计算请求耗时
-        time_used = int((time.time() - start) * 1000)
+        report, (url, headers, params, files, result) = prepared
+        # 延时由调度器处理，到这里时已经延时完成
+        # 等待 host 的并发限制时不阻塞事件循环
+        if self.limiter:
+            await loop.run_in_executor(None, self.limiter.acquire, url)
+        try:
+            # 请求开始时间
+            start = time.time()
+            # 请求
+            result = await self.__do_request_async(session, url, headers, params, files, result, case_info)
+            # 计算请求耗时
+            time_used = int((time.time() - start) * 1000)
+        finally:
+            if self.limiter:
+                self.limiter.release(url)
         # 校验结果
         self.__check_status(report, result, time_used)
 
@@ -215,6 +448,8 @@ class Executor:
             headers.pop(CONTENT_TYPE)
             # 循环 params 字典
             has_file = False
+            # backend.handler 导入时依赖 backend.util，在此处导入避免 backend.util 单独导入(如 spawn 子进程)时循环导入
+            from backend.handler.file import file
             for key, value in params.items():
                 # 若值为字符串，并且以 file: 开头，则认为为文件上传
                 if isinstance(value, str) and value.startswith('file:'):
@@ -250,22 +485,24 @@ class Executor:
         # 请求接口
         method = case_info.method
         try:
+            # 取对应 host 的会话，复用连接
+            session = self.sessions.get(url) if self.sessions else requests
             # POST
             if method == 'post':
-                response = requests.post(url, data=params, headers=headers, files=files)
-                result = response.json()
+                response = session.post(url, data=params, headers=headers, files=files, stream=True)
+                result = self.__read_json(response, result, case_info)
             # GET
             elif method == "get":
-                response = requests.get(url, data=params, headers=headers)
-                result = response.json()
+                response = session.get(url, data=params, headers=headers, stream=True)
+                result = self.__read_json(response, result, case_info)
             # DELETE
             elif method == "delete":
-                response = requests.delete(url, data=params, headers=headers)
-                result = response.json()
+                response = session.delete(url, data=params, headers=headers, stream=True)
+                result = self.__read_json(response, result, case_info)
             # PUT
             elif method == "put":
-                response = requests.put(url, data=params, headers=headers, files=files)
-                result = response.json()
+                response = session.put(url, data=params, headers=headers, files=files, stream=True)
+                result = self.__read_json(response, result, case_info)
             # 未知方法
             else:
                 response = Response()
@@ -276,6 +513,121 @@ class Executor:
             result.update({'message': '请求失败，请检查用例的请求路径、请求方法、请求参数是否正确'})
         return result
 
+    def __read_json(self, response, result, case_info):
+        """
+        分块读取响应内容并解析
+
+        分块读取只用于超过最大读取大小时尽早放弃，不是流式解析，读取完成后仍一次解析完整内容，
+        单个响应占用的内存上限为 RESPONSE_MAX_SIZE；超过采集大小时只限制保存到报告中的内容
+        """
+
+        body = bytearray()
+        try:
+            for chunk in response.iter_content(chunk_size=RESPONSE_CHUNK_SIZE):
+                body.extend(chunk)
+                if len(body) > RESPONSE_MAX_SIZE:
+                    return self.__oversize(result)
+        finally:
+            response.close()
+        return self.__parse_body(body, case_info)
+
+    async def __read_json_async(self, response, result, case_info):
+        """
+        分块读取响应内容并解析
+
+        与 __read_json 保持一致的处理逻辑
+        """
+
+        body = bytearray()
+        async for chunk in response.content.iter_chunked(RESPONSE_CHUNK_SIZE):
+            body.extend(chunk)
+            if len(body) > RESPONSE_MAX_SIZE:
+                return self.__oversize(result)
+        return self.__parse_body(body, case_info)
+
+    @staticmethod
+    def __oversize(result):
+        """
+        响应内容超过最大读取大小
+        """
+
+        result.update({'message': '响应内容超过 {} 字节，已放弃读取'.format(RESPONSE_MAX_SIZE), TRUNCATED: True})
+        return result
+
+    def __parse_body(self, body, case_info):
+        """
+        解析响应内容
+
+        超过采集大小时只保留 code、当前用例预期以及依赖当前用例的取值步骤对应的字段，并添加截断标记
+        顶层不是对象(如数组)时没有可以保留的字段，只返回截断标记
+        """
+
+        result = json.loads(bytes(body))
+        if len(body) <= RESPONSE_CAPTURE_SIZE:
+            return result
+        captured = {TRUNCATED: True, 'size': len(body)}
+        if not isinstance(result, dict):
+            return captured
+        for path in self.captures.get(case_info.id, ()):
+            try:
+                value = path.get(result)
+            except (IndexError, TypeError, AttributeError):
+                continue
+            if value is not None:
+                path.set(value, captured)
+        return captured
+
+    async def __do_request_async(self, session, url, headers, params, files, result, case_info):
+        """
+        异步请求用例
+
+        与 __do_request 保持一致的处理逻辑
+        """
+
+        method = case_info.method
+        # 未知方法
+        if method not in ('post', 'get', 'delete', 'put'):
+            result.update({'message': '请求方法不支持，请检查用例'})
+            result.update({'http_code': 200})
+            return result
+        # 只有 POST 和 PUT 上传文件
+        files = files if method in ('post', 'put') else None
+        try:
+            data = self.__build_form_data(params, files)
+            async with session.request(method, url, data=data, headers=headers) as response:
+                result = await self.__read_json_async(response, result, case_info)
+                result.update({'http_code': response.status})
+        except Exception:
+            result.update({'message': '请求失败，请检查用例的请求路径、请求方法、请求参数是否正确'})
+        return result
+
+    @staticmethod
+    def __build_form_data(params, files):
+        """
+        将 requests 风格的 data 以及 files 转为 aiohttp 的请求体
+        """
+
+        if not isinstance(params, dict):
+            return params
+        # 不含文件的 form-data 在构建参数时被处理为 (None, value)
+        is_form = files or any(isinstance(value, tuple) for value in params.values())
+        if not is_form:
+            return params
+        import aiohttp
+        data = aiohttp.FormData()
+        for key, value in params.items():
+            if isinstance(value, tuple):
+                value = value[1]
+            # 上传文件的字段由 files 提供
+            if files and key in files:
+                continue
+            data.add_field(key, value if isinstance(value, str) else json.dumps(value))
+        if files:
+            for key, value in files.items():
+                if value is not None:
+                    data.add_field(key, value)
+        return data
+
     def __check_status(self, report, result, time_used):
         """
         校验结果
@@ -300,33 +652,25 @@ class Executor:
         # 定义预期和结果字典
         expected = {}
         response = {}
-        # 预期字段
-        expected_keys = report.expected_keys
-        # 预期结果
-        expected_values = report.expected_values
-        # 如果预期没填，直接成功
-        if expected_keys and expected_values:
-            # 循环预期字段的个数
-            for key, p in zip(expected_keys, expected_values):
-                key = key[0]
-                steps = [ste['value'] for ste in p['steps']]
-                # 是否存在接口依赖
-                if 'depend' not in p or not isinstance(p['depend'], int):
-                    # 将预期字段以及预期值放入预期字典
-                    expected.update({key: p['value']})
-                else:
-                    # 取依赖的行数据
-                    report = filter_obj_single(self.reports, 'case_id', int(p['depend']))
-                    # 没取到直接判定失败
-                    if not report:
-                        report.status = FAILED
-                        return
-                    # 否则按照依赖步骤取出依赖值，填充预期字典
-                    content = report.response_content
-                    expected.update({key: get_value(content, steps)})
-
-                # 将预期字段对应的结果从结果中取出(由于这种情况)
-                response.update({key: str(get_value(result, steps))})
+        # 循环预编译的预期，如果预期没填，直接成功
+        for key, depend, steps, value in self.expects.get(report.case_id, ()):
+            # 是否存在接口依赖
+            if depend is None:
+                # 将预期字段以及预期值放入预期字典
+                expected.update({key: value})
+            else:
+                # 取依赖的行数据
+                depend_report = self.report_index.get(depend)
+                # 没取到直接判定失败
+                if not depend_report:
+                    report.status = FAILED
+                    return
+                # 否则按照依赖步骤取出依赖值，填充预期字典
+                content = depend_report.response_content
+                expected.update({key: steps.get(content)})
+
+            # 将预期字段对应的结果从结果中取出(由于这种情况)
+            response.update({key: str(steps.get(result))})
         # 填入结果
         if expected == response:
             report.status = PASSED
@@ -346,21 +690,15 @@ class Executor:
         # 获取当前用例的 params
         params = case_info.params
         params = {} if params is None else params
-        # 取当前用例的 extend_keys
-        extend_keys = case_info.extend_keys
-        # 如果有需要处理的占位符
-        if extend_keys:
-            # 循环注入的字段和取值字典
-            for key, p in zip(extend_keys, case_info.extend_values):
-                process = Process()
-                process.__dict__ = p
-                # 取值
-                value = self.__get_value(process.depend, process.steps)
-                # 取到的值为数字类型的字符串转为 int 类型
-                if isinstance(value, str) and value.isdigit():
-                    value = int(value)
-                # 将取出的值插入以对应的字段名插入到 params 中
-                set_value(value, params, key)
+        # 循环预编译的注入字段和取值步骤
+        for key, depend, steps in self.extends.get(case_info.id, ()):
+            # 取值
+            value = self.__get_value(depend, steps)
+            # 取到的值为数字类型的字符串转为 int 类型
+            if isinstance(value, str) and value.isdigit():
+                value = int(value)
+            # 将取出的值插入以对应的字段名插入到 params 中
+            key.set(value, params)
         # 处理完成后设置回用例对象中
         case_info.params = params
 
@@ -399,11 +737,11 @@ class Executor:
 
     def __get_value(self, row, steps):
         """
-        从给定行数和取值步骤，取出需要的值
+        从给定行数和预编译的取值步骤，取出需要的值
         """
 
         # 取依赖的行数据
-        report = filter_obj_single(self.reports, 'case_id', int(row))
+        report = self.report_index.get(row)
         # 没有取到返回 None
         if not report:
             return None
@@ -413,4 +751,4 @@ class Executor:
         if not content:
             return None
         # 以给定对象和取值步骤去取出对应数据
-        return get_value(content, steps)
+        return steps.get(content)
@@ -0,0 +1,113 @@
+import threading
+from http.cookiejar import DefaultCookiePolicy
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def host_key(url):
+    """
+    取请求地址的协议以及 host 作为键
+    """
+
+    parts = urlsplit(url) if isinstance(url, str) else None
+    return (parts.scheme, parts.netloc) if parts else ('', '')
+
+
+class SessionPool:
+    """
+    单次执行内共享的 HTTP 会话
+
+    按 host 区分会话，每个会话持有自己的连接池，同一 host 的请求复用 keep-alive 连接
+    会话不保存 cookie，与逐个请求时一样，用例之间不共享状态
+    执行结束后需要调用 close 关闭所有连接
+    """
+
+    def __init__(self, pool_size=10, retries=0):
+        self.pool_size = max(1, int(pool_size)) if pool_size else 1
+        self.retries = retries
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        """
+        根据请求地址获取对应 host 的会话
+        """
+
+        key = host_key(url)
+        session = self.sessions.get(key)
+        if session is None:
+            with self.lock:
+                session = self.sessions.get(key)
+                if session is None:
+                    session = self.__create()
+                    self.sessions[key] = session
+        return session
+
+    def __create(self):
+        """
+        创建会话，挂载连接池以及重试策略
+        """
+
+        session = requests.Session()
+        # 会话只用于复用连接，不保存 cookie，避免不相关的用例之间共享状态
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        # 用例请求不一定幂等，只对建立连接失败的情况进行重试
+        retry = Retry(total=self.retries, connect=self.retries, read=0, status=0, redirect=None,
+                      backoff_factor=0.1, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def close(self):
+        """
+        关闭所有会话以及连接
+        """
+
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+
+
+class HostLimiter:
+    """
+    按 host 限制同时进行中的请求数
+
+    可在多次执行之间共享，用于批量执行多个项目时限制对同一个被测服务的并发
+    """
+
+    def __init__(self, limit=10):
+        self.limit = max(1, int(limit)) if limit else 1
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, url):
+        self.__semaphore(url).acquire()
+
+    def release(self, url):
+        self.__semaphore(url).release()
+
+    @contextmanager
+    def hold(self, url):
+        """
+        在同一 host 的并发限制内执行
+        """
+
+        self.acquire(url)
+        try:
+            yield
+        finally:
+            self.release(url)
+
+    def __semaphore(self, url):
+        key = host_key(url)
+        with self.lock:
+            semaphore = self.semaphores.get(key)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.limit)
+                self.semaphores[key] = semaphore
+        return semaphore
@@ -0,0 +1,331 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.core.cache import cache
+from django.db import connection
+from backend.settings import *
+from backend.util.jwt_token import UserHolder
+from testing_platform.settings import LOGGER
+
+# 后台执行任务的线程池
+# 任务只在当前进程中执行，不使用进程池或者 Redis 队列：任务随 WSGI 工作进程退出而中断，其他工作进程也看不到，
+# 进度与心跳写在共享缓存中，任何工作进程都可以查询，中断的记录由心跳检查标记为执行失败
+pool = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='execute-job')
+
+
+class Heartbeat:
+    """
+    当前进程中执行中记录的心跳
+
+    任务只存在于进程内存中，进程重启或者退出后心跳随缓存过期，
+    定期检查时将没有心跳的执行中记录标记为执行失败
+    """
+
+    def __init__(self):
+        self.records = set()
+        self.sweepers = []
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def watch(self, record_id):
+        """
+        记录开始执行(包括排队中)
+        """
+
+        with self.lock:
+            self.records.add(record_id)
+        cache.set(Heartbeat.key(record_id), 1, timeout=JOB_HEARTBEAT_TIMEOUT)
+        self.start()
+
+    def unwatch(self, record_id):
+        """
+        记录执行结束
+        """
+
+        with self.lock:
+            self.records.discard(record_id)
+        cache.delete(Heartbeat.key(record_id))
+
+    def on_sweep(self, func):
+        """
+        注册定期检查的函数
+
+        只注册不启动线程，导入模块的进程(迁移、测试、命令行、子进程等)不会启动心跳线程，
+        第一次提交任务或者开始执行记录时才启动
+        """
+
+        self.sweepers.append(func)
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.__loop, name='execute-heartbeat', daemon=True)
+                self.thread.start()
+
+    def __loop(self):
+        """
+        定期刷新心跳以及检查已中断的记录
+
+        启动后第一次检查等待一个心跳超时，其他进程的心跳已经写入缓存
+        """
+
+        swept_at = time.time() - JOB_SWEEP_INTERVAL + JOB_HEARTBEAT_TIMEOUT
+        while True:
+            time.sleep(JOB_HEARTBEAT_INTERVAL)
+            try:
+                with self.lock:
+                    record_ids = list(self.records)
+                if record_ids:
+                    cache.set_many({Heartbeat.key(record_id): 1 for record_id in record_ids},
+                                   timeout=JOB_HEARTBEAT_TIMEOUT)
+                if time.time() - swept_at >= JOB_SWEEP_INTERVAL:
+                    swept_at = time.time()
+                    for func in self.sweepers:
+                        func()
+            except Exception as e:
+                LOGGER.exception(e)
+            finally:
+                connection.close()
+
+    @staticmethod
+    def key(record_id):
+        return 'execute:heartbeat:' + str(record_id)
+
+    @staticmethod
+    def alive(record_ids):
+        """
+        返回仍有心跳的记录 id
+        """
+
+        keys = {Heartbeat.key(record_id): record_id for record_id in record_ids}
+        if not keys:
+            return set()
+        return {keys[key] for key in cache.get_many(list(keys))}
+
+
+# 当前进程的心跳
+heartbeat = Heartbeat()
+
+
+def submit(owner, func, *args, **kwargs):
+    """
+    提交后台任务
+
+    任务线程中没有当前用户，需要将发起任务的用户带过去
+    任务在当前进程的线程池中执行，进程退出时未完成的任务会丢失，由心跳检查清理对应的记录
+    """
+
+    heartbeat.start()
+
+    def run():
+        try:
+            in_context(owner, func, *args, **kwargs)
+        except Exception as e:
+            LOGGER.exception(e)
+
+    return pool.submit(run)
+
+
+def map_all(owner, func, items, workers):
+    """
+    使用独立的线程池并发处理 items 中的每一项，按顺序返回结果
+    """
+
+    with ThreadPoolExecutor(max_workers=max(1, int(workers))) as batch_pool:
+        return list(batch_pool.map(lambda item: in_context(owner, func, item), items))
+
+
+def in_context(owner, func, *args, **kwargs):
+    """
+    以指定用户的身份在当前线程中执行
+    """
+
+    UserHolder.cache_user(owner)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        # 任务线程中打开的数据库连接需要手动关闭
+        connection.close()
+
+
+class Progress:
+    """
+    记录的执行进度
+
+    保存在缓存中，便于轮询查询，写缓存有最小间隔，避免每个用例执行完都写一次
+    """
+
+    def __init__(self, record_id, total):
+        self.record_id = record_id
+        self.total = total
+        self.done = 0
+        self.passed = 0
+        self.failed = 0
+        self.ignored = 0
+        self.status = RUNNING
+        self.flushed_at = 0
+        self.lock = threading.Lock()
+
+    def update(self, report):
+        """
+        单个用例执行完成
+        """
+
+        with self.lock:
+            self.done += 1
+            if report is not None:
+                if report.status == PASSED:
+                    self.passed += 1
+                elif report.status == IGNORED:
+                    self.ignored += 1
+                else:
+                    self.failed += 1
+            if time.time() - self.flushed_at >= JOB_PROGRESS_INTERVAL:
+                self.flush()
+
+    def finish(self, status):
+        """
+        执行结束
+        """
+
+        with self.lock:
+            self.status = status
+            self.flush()
+
+    def flush(self):
+        """
+        写入缓存
+        """
+
+        self.flushed_at = time.time()
+        cache.set(Progress.key(self.record_id), self.to_dict(), timeout=JOB_PROGRESS_TIMEOUT)
+
+    def to_dict(self):
+        return {
+            'id': self.record_id,
+            'status': self.status,
+            'total': self.total,
+            'done': self.done,
+            'passed': self.passed,
+            'failed': self.failed,
+            'ignored': self.ignored
+        }
+
+    @staticmethod
+    def key(record_id):
+        return 'execute:progress:' + str(record_id)
+
+    @staticmethod
+    def get(record_id):
+        """
+        从缓存中取执行进度，不存在返回 None
+        """
+
+        return cache.get(Progress.key(record_id))
+
+
+class ImportProgress:
+    """
+    导入任务的进度
+
+    以 sheet 页为单位记录，保存在缓存中供轮询查询
+    """
+
+    def __init__(self, job_id, total):
+        self.job_id = job_id
+        self.total = total
+        self.done = 0
+        self.cases = 0
+        self.status = RUNNING
+        self.message = None
+        self.lock = threading.Lock()
+
+    def update(self, cases):
+        """
+        单个 sheet 页解析完成
+        """
+
+        with self.lock:
+            self.done += 1
+            self.cases += cases
+            self.flush()
+
+    def finish(self, status, message=None):
+        """
+        导入结束
+        """
+
+        with self.lock:
+            self.status = status
+            self.message = message
+            self.flush()
+
+    def flush(self):
+        """
+        写入缓存
+        """
+
+        cache.set(ImportProgress.key(self.job_id), self.to_dict(), timeout=JOB_PROGRESS_TIMEOUT)
+
+    def to_dict(self):
+        return {
+            'id': self.job_id,
+            'status': self.status,
+            'total': self.total,
+            'done': self.done,
+            'cases': self.cases,
+            'message': self.message
+        }
+
+    @staticmethod
+    def key(job_id):
+        return 'import:progress:' + str(job_id)
+
+    @staticmethod
+    def get(job_id):
+        """
+        从缓存中取导入进度，不存在返回 None
+        """
+
+        return cache.get(ImportProgress.key(job_id))
+
+
+class BatchProgress:
+    """
+    批量执行的进度
+
+    缓存中只保存批次包含的测试记录 id 以及跳过的项目，查询时由各个记录的执行进度汇总
+    """
+
+    def __init__(self, batch_id, projects, record_ids, skipped):
+        self.batch_id = batch_id
+        self.projects = projects
+        self.record_ids = record_ids
+        self.skipped = skipped
+
+    def flush(self):
+        """
+        写入缓存
+        """
+
+        cache.set(BatchProgress.key(self.batch_id), self.to_dict(), timeout=JOB_PROGRESS_TIMEOUT)
+
+    def to_dict(self):
+        return {
+            'id': self.batch_id,
+            'projects': self.projects,
+            'records': self.record_ids,
+            'skipped': self.skipped
+        }
+
+    @staticmethod
+    def key(batch_id):
+        return 'execute:batch:' + str(batch_id)
+
+    @staticmethod
+    def get(batch_id):
+        """
+        从缓存中取批量执行的信息，不存在返回 None
+        """
+
+        return cache.get(BatchProgress.key(batch_id))
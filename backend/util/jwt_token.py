@@ -65,3 +65,11 @@ class UserHolder:
             return UserHolder.local.token
         except AttributeError:
             return None
+
+    @staticmethod
+    def clear():
+        """
+        清除当前线程缓存的用户以及 token，线程会被不同请求复用，每次请求开始时调用
+        """
+        UserHolder.local.principle = None
+        UserHolder.local.token = None
@@ -0,0 +1,62 @@
+import threading
+import time
+from collections import OrderedDict
+from backend.settings import AUTH_CACHE_SIZE, AUTH_CACHE_TIMEOUT
+
+
+class LocalCache:
+    """
+    进程内的 TTL/LRU 缓存
+
+    放在 Redis 以及数据库之前，减少高频请求的网络往返
+    只在当前进程内有效，多进程部署时其他进程最长在 timeout 秒后才能感知变化
+    """
+
+    def __init__(self, max_size=1024, timeout=60):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        取缓存，不存在或者已过期返回 None
+        """
+
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            value, expired_at = item
+            if expired_at <= time.monotonic():
+                del self.items[key]
+                return None
+            # 最近使用的移到末尾
+            self.items.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        """
+        设置缓存，超出容量时淘汰最久未使用的
+        """
+
+        expired_at = time.monotonic() + (self.timeout if timeout is None else timeout)
+        with self.lock:
+            self.items[key] = (value, expired_at)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+# token 到用户 id 以及上次刷新过期时间的缓存
+tokens = LocalCache(AUTH_CACHE_SIZE, AUTH_CACHE_TIMEOUT)
+# secret 到用户 id 的缓存
+secrets = LocalCache(AUTH_CACHE_SIZE, AUTH_CACHE_TIMEOUT)
@@ -0,0 +1,175 @@
+import bisect
+import threading
+import time
+import redis
+from backend.settings import METRICS_BUCKETS
+
+
+class RequestStats:
+    """
+    当前请求内的数据库以及 Redis 访问统计
+
+    保存在线程本地变量中，由指标中间件在请求开始时重置
+    """
+
+    local = threading.local()
+
+    @staticmethod
+    def reset():
+        RequestStats.local.stats = {'queries': 0, 'query_time': 0.0, 'redis_calls': 0, 'redis_time': 0.0}
+
+    @staticmethod
+    def current():
+        """
+        取当前请求的统计，不在请求中返回 None
+        """
+
+        return getattr(RequestStats.local, 'stats', None)
+
+    @staticmethod
+    def clear():
+        RequestStats.local.stats = None
+
+    @staticmethod
+    def add(count_key, time_key, used):
+        stats = RequestStats.current()
+        if stats is not None:
+            stats[count_key] += 1
+            stats[time_key] += used
+
+
+def record_query(execute, sql, params, many, context):
+    """
+    数据库执行包装，统计查询次数以及耗时
+    """
+
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        RequestStats.add('queries', 'query_time', time.perf_counter() - start)
+
+
+class MetricsRedis(redis.Redis):
+    """
+    统计命令次数以及耗时的 Redis 客户端
+
+    通过缓存配置中的 REDIS_CLIENT_CLASS 启用
+    """
+
+    def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            RequestStats.add('redis_calls', 'redis_time', time.perf_counter() - start)
+
+
+class Histogram:
+    """
+    按标签区分的累计直方图
+    """
+
+    def __init__(self, buckets):
+        self.buckets = sorted(buckets)
+        # 标签到各区间计数、总和以及总数的映射
+        self.values = {}
+
+    def observe(self, labels, value):
+        item = self.values.get(labels)
+        if item is None:
+            item = [[0] * len(self.buckets), 0.0, 0]
+            self.values[labels] = item
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            item[0][index] += 1
+        item[1] += value
+        item[2] += 1
+
+    def render(self, name, label_names):
+        lines = []
+        for labels, (counts, total, count) in sorted(self.values.items()):
+            label = format_labels(label_names, labels)
+            cumulative = 0
+            for bucket, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append('%s_bucket{%s,le="%s"} %d' % (name, label, bucket, cumulative))
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, label, count))
+            lines.append('%s_sum{%s} %s' % (name, label, repr(total)))
+            lines.append('%s_count{%s} %d' % (name, label, count))
+        return lines
+
+
+class Counter:
+    """
+    按标签区分的计数器
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    def inc(self, labels, value=1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self, name, label_names):
+        return ['%s{%s} %s' % (name, format_labels(label_names, labels), repr(value))
+                for labels, value in sorted(self.values.items())]
+
+
+def format_labels(label_names, labels):
+    return ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for name, value in zip(label_names, labels))
+
+
+class Metrics:
+    """
+    进程内的请求指标，以 Prometheus 文本格式输出
+    """
+
+    LABELS = ('view', 'method', 'status')
+    VIEW_LABELS = ('view',)
+
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.latency = Histogram(buckets)
+        self.queries = Counter()
+        self.query_time = Counter()
+        self.redis_calls = Counter()
+        self.redis_time = Counter()
+
+    def observe(self, view, method, status, used, stats):
+        """
+        记录一次请求
+        """
+
+        with self.lock:
+            self.latency.observe((view, method, str(status)), used)
+            if stats is not None:
+                self.queries.inc((view,), stats['queries'])
+                self.query_time.inc((view,), stats['query_time'])
+                self.redis_calls.inc((view,), stats['redis_calls'])
+                self.redis_time.inc((view,), stats['redis_time'])
+
+    def render(self):
+        """
+        输出 Prometheus 文本格式
+        """
+
+        metrics = [
+            ('platform_request_seconds', 'histogram', '请求耗时', self.latency, self.LABELS),
+            ('platform_db_queries_total', 'counter', '数据库查询次数', self.queries, self.VIEW_LABELS),
+            ('platform_db_query_seconds_total', 'counter', '数据库查询耗时', self.query_time, self.VIEW_LABELS),
+            ('platform_redis_commands_total', 'counter', 'Redis 命令次数', self.redis_calls, self.VIEW_LABELS),
+            ('platform_redis_seconds_total', 'counter', 'Redis 命令耗时', self.redis_time, self.VIEW_LABELS),
+        ]
+        lines = []
+        with self.lock:
+            for name, kind, help, metric, label_names in metrics:
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s %s' % (name, kind))
+                lines.extend(metric.render(name, label_names))
+        return '\n'.join(lines) + '\n'
+
+
+# 当前进程的指标
+metrics = Metrics(METRICS_BUCKETS)
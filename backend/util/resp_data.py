@@ -7,6 +7,7 @@ from django.db.models import Model
 from django.forms import model_to_dict
 from django.http.response import JsonResponse
 from backend.exception import ErrorCode
+from backend.util.utils import CursorPage
 
 
 class ExtendedEncoder(DjangoJSONEncoder):
@@ -19,7 +20,7 @@ class ExtendedEncoder(DjangoJSONEncoder):
         if isinstance(obj, Model):
             return obj_to_dict(obj, exclude=['password', 'owner'])
         # Paginator 对象转字典，针对分页情况
-        if isinstance(obj, Page):
+        if isinstance(obj, (Page, CursorPage)):
             return page_to_dict(obj)
         # 都不是，采用默认父类序列化方式
         if isinstance(obj, datetime.datetime):
@@ -28,6 +29,15 @@ class ExtendedEncoder(DjangoJSONEncoder):
 
 
 def page_to_dict(obj):
+    # 游标分页没有页码，返回下一页的游标
+    if isinstance(obj, CursorPage):
+        return {
+            'page_size': obj.page_size,
+            'cursor': obj.cursor,
+            'has_next': obj.has_next,
+            'total': obj.total,
+            'records': obj.object_list
+        }
     paginator = obj.paginator
     return {
         'page': obj.number,
@@ -42,7 +52,11 @@ def obj_to_dict(obj, exclude=None):
     """
     调用 from django.db.models import Model#model_to_dict() 完成 Model 原有字段的转换
     然后手动完成其他添加字段的转换
+    延迟加载的字段不转换，避免序列化时逐条查询
     """
+    deferred = obj.get_deferred_fields()
+    if deferred:
+        exclude = list(exclude or []) + list(deferred)
     data = model_to_dict(obj, exclude=exclude)
     # 对象转字典
     properties = obj.__dict__
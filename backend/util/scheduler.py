@@ -0,0 +1,196 @@
+import asyncio
+import heapq
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from backend.exception import ErrorCode, PlatformError
+
+
+def parse_depends(case_info):
+    """
+    解析用例依赖的用例 id
+
+    依赖来源于 extend_values 以及 expected_values 中的 depend
+    """
+
+    depends = set()
+    for values in (case_info.extend_values, case_info.expected_values):
+        if not values or not isinstance(values, list):
+            continue
+        for value in values:
+            if not isinstance(value, dict):
+                continue
+            depend = value.get('depend')
+            # 没有依赖
+            if depend is None or depend == '':
+                continue
+            try:
+                depends.add(int(depend))
+            except (TypeError, ValueError):
+                continue
+    return depends
+
+
+class CaseScheduler:
+    """
+    基于用例依赖关系(有向无环图)的调度器
+
+    无依赖关系的用例并发执行，有依赖的用例在其依赖全部执行完成后才会执行
+    同一时刻可执行的用例按照原有 sort 顺序优先调度
+    需要延时的用例在依赖完成后开始计时，等待期间其他用例照常执行
+    并发数为 1 时与原有逻辑一致，严格按 sort 顺序逐个执行，延时会阻塞后续用例
+    """
+
+    def __init__(self, case_infos, workers=1):
+        self.case_infos = {case_info.id: case_info for case_info in case_infos}
+        self.workers = max(1, int(workers)) if workers else 1
+        # 逐个执行，延时不使用定时器，保证未声明依赖的用例仍按顺序执行
+        self.sequential = self.workers == 1
+        # 用例原有顺序
+        self.orders = {case_info.id: index for index, case_info in enumerate(case_infos)}
+        # 用例依赖的用例
+        self.depends = {}
+        # 依赖于当前用例的用例
+        self.dependents = {case_id: [] for case_id in self.case_infos}
+        # 用例延时，不执行的用例不需要延时
+        self.delays = {case_id: case_info.delay if case_info.run and case_info.delay else 0
+                       for case_id, case_info in self.case_infos.items()}
+        for case_id, case_info in self.case_infos.items():
+            # 只处理本次执行范围内的依赖，依赖自身时取不到结果，与原有逻辑一致，不作为依赖处理
+            depends = {depend for depend in parse_depends(case_info) if depend in self.case_infos and depend != case_id}
+            self.depends[case_id] = depends
+            for depend in depends:
+                self.dependents[depend].append(case_id)
+        self.__check_cycle()
+
+    def __check_cycle(self):
+        """
+        检查依赖是否存在环
+        """
+
+        pending = {case_id: len(depends) for case_id, depends in self.depends.items()}
+        ready = [case_id for case_id, count in pending.items() if count == 0]
+        visited = 0
+        while ready:
+            case_id = ready.pop()
+            visited += 1
+            for dependent in self.dependents[case_id]:
+                pending[dependent] -= 1
+                if pending[dependent] == 0:
+                    ready.append(dependent)
+        # 存在没有被访问到的用例，说明存在环
+        if visited != len(self.case_infos):
+            names = [str(self.case_infos[case_id].name) for case_id, count in pending.items() if count > 0]
+            raise PlatformError.error_args(ErrorCode.CASE_DEPEND_CYCLE, ', '.join(names))
+
+    def run(self, task):
+        """
+        按依赖关系调度执行所有用例
+
+        task 为接收单个用例的执行函数
+        """
+
+        if not self.case_infos:
+            return
+        pending, ready, timers = self.__init_queues()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            running = {}
+            while ready or running or timers:
+                timeout = self.__due(ready, timers)
+                # 填满工作线程
+                while ready and len(running) < self.workers:
+                    _, case_id = heapq.heappop(ready)
+                    if self.sequential and self.delays[case_id]:
+                        time.sleep(self.delays[case_id])
+                    running[pool.submit(task, self.case_infos[case_id])] = case_id
+                # 只剩下延时中的用例，等待最近的一个到期
+                if not running:
+                    time.sleep(timeout)
+                    continue
+                done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    case_id = running.pop(future)
+                    # 执行出现异常直接抛出
+                    future.result()
+                    self.__complete(case_id, pending, ready, timers)
+
+    async def run_async(self, task):
+        """
+        在事件循环中按依赖关系调度执行所有用例
+
+        task 为接收单个用例并返回协程的函数
+        """
+
+        if not self.case_infos:
+            return
+        pending, ready, timers = self.__init_queues()
+        running = {}
+        while ready or running or timers:
+            timeout = self.__due(ready, timers)
+            # 同时进行中的用例不超过并发数
+            while ready and len(running) < self.workers:
+                _, case_id = heapq.heappop(ready)
+                if self.sequential and self.delays[case_id]:
+                    await asyncio.sleep(self.delays[case_id])
+                running[asyncio.ensure_future(task(self.case_infos[case_id]))] = case_id
+            # 只剩下延时中的用例，等待最近的一个到期
+            if not running:
+                await asyncio.sleep(timeout)
+                continue
+            done, _ = await asyncio.wait(list(running), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                case_id = running.pop(future)
+                # 执行出现异常直接抛出
+                future.result()
+                self.__complete(case_id, pending, ready, timers)
+
+    def __init_queues(self):
+        """
+        初始化待完成依赖数、就绪队列以及延时队列
+        """
+
+        pending = {case_id: len(depends) for case_id, depends in self.depends.items()}
+        ready = []
+        timers = []
+        for case_id, count in pending.items():
+            if count == 0:
+                self.__release(case_id, ready, timers)
+        return pending, ready, timers
+
+    def __complete(self, case_id, pending, ready, timers):
+        """
+        用例执行完成，依赖全部完成的用例进入就绪队列或者延时队列
+        """
+
+        for dependent in self.dependents[case_id]:
+            pending[dependent] -= 1
+            if pending[dependent] == 0:
+                self.__release(dependent, ready, timers)
+
+    def __release(self, case_id, ready, timers):
+        """
+        用例依赖已全部完成
+
+        需要延时的用例以定时器的方式放入延时队列，到期后才进入就绪队列，不占用工作线程
+        逐个执行时直接进入就绪队列，取出执行前再等待
+        """
+
+        delay = self.delays[case_id]
+        if delay > 0 and not self.sequential:
+            heapq.heappush(timers, (time.monotonic() + delay, self.orders[case_id], case_id))
+        else:
+            heapq.heappush(ready, (self.orders[case_id], case_id))
+
+    def __due(self, ready, timers):
+        """
+        将到期的延时用例放入就绪队列
+
+        返回距离下一个定时器到期的秒数，没有定时器返回 None
+        """
+
+        now = time.monotonic()
+        while timers and timers[0][0] <= now:
+            _, order, case_id = heapq.heappop(timers)
+            heapq.heappush(ready, (order, case_id))
+        if not timers:
+            return None
+        return max(0, timers[0][0] - now)
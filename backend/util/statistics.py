@@ -0,0 +1,56 @@
+from django.core.cache import cache
+from django.db import transaction
+from backend.settings import STATISTICS_TIMEOUT
+from backend.util.jwt_token import UserHolder
+
+# 项目数、用例数、记录数
+PROJECT = 'project'
+CASE = 'case'
+RECORD = 'record'
+
+
+def key(owner, name):
+    return 'statistics:' + str(owner) + ':' + name
+
+
+def incr(name, delta=1, owner=None):
+    """
+    增量更新用户的统计计数
+
+    在事务提交后更新，事务回滚不会影响计数；缓存不存在时不处理，查询时重新计算
+    """
+
+    if not delta:
+        return
+    cache_key = key(owner if owner is not None else UserHolder.current_user(), name)
+
+    def update():
+        try:
+            cache.incr(cache_key, delta)
+        except ValueError:
+            pass
+
+    transaction.on_commit(update)
+
+
+def get(owner, loaders):
+    """
+    查询用户的统计计数
+
+    所有计数一次从缓存中取出，缓存不存在的计数调用 loaders 中对应的函数重新计算后写入缓存
+    缓存有过期时间，过期后重新计算，避免计数长期偏差
+    """
+
+    keys = {name: key(owner, name) for name in loaders}
+    cached = cache.get_many(list(keys.values()))
+    result = {}
+    missing = {}
+    for name, cache_key in keys.items():
+        if cache_key in cached:
+            result[name] = cached[cache_key]
+        else:
+            result[name] = loaders[name]()
+            missing[cache_key] = result[name]
+    if missing:
+        cache.set_many(missing, timeout=STATISTICS_TIMEOUT)
+    return result
@@ -1,11 +1,19 @@
 import json
+from itertools import islice
 
 import openpyxl
+from django.db.models import QuerySet
 from openpyxl import load_workbook
 from backend.models import CaseInfo
 
 
-def build_extend(info, ex_keys, ex_values, cases):
+def build_extend(info, ex_keys, ex_values, rows):
+    """
+    构建注入字段以及注入值
+
+    rows 为行号到用例的映射，依赖的用例可能尚未入库，depend 先记录用例对象，入库后再替换为 id
+    """
+
     if not ex_keys:
         return
     keys = ex_keys.split(',')
@@ -17,8 +25,7 @@ def build_extend(info, ex_keys, ex_values, cases):
         value = values[i]
         depend_keys = value.split(':')
         row = int(depend_keys[0])
-        filter_cases = [case for case in cases if case.row == row]
-        depend = filter_cases[0].id
+        depend = rows[row]
         steps = depend_keys[1].split('.')
         extend_values.append({
             'depend': depend,
@@ -28,22 +35,19 @@ def build_extend(info, ex_keys, ex_values, cases):
     info.extend_values = extend_values
 
 
-def parse_extend(case_info, case_infos):
+def parse_extend(case_info, rows):
+    """
+    解析注入字段以及注入值为 Excel 中的格式
+
+    rows 为用例 id 到行号的映射
+    """
+
     if not case_info or not case_info.extend_keys:
         return None, None
-    case_info.extend_keys = json.loads(case_info.extend_keys)
-    case_info.extend_values = json.loads(case_info.extend_values)
     keys = []
     for key in case_info.extend_keys:
         keys.append(key[0])
-    # values = []
-    # for value in case_info.extend_values:
-    #     depends = [case for case in case_infos if case.id == int(value['depend'])]
-    #     depend = depends[0]
-    #     values.
-    var = [str([case for case in case_infos if case.id == value['depend']][0].row) + ':' + ('.'.join(value['steps']))
-           for value
-           in case_info.extend_values]
+    var = [str(rows[value['depend']]) + ':' + ('.'.join(value['steps'])) for value in case_info.extend_values]
     return ",".join(keys), ','.join(var)
 
 
@@ -68,9 +72,9 @@ def build_expected(info, ex_keys, ex_values, check_steps):
 
 
 def parse_expected(case_info):
+    if not case_info.expected_keys:
+        return None, None, None
     expected_keys = []
-    case_info.expected_keys = json.loads(case_info.expected_keys)
-    case_info.expected_values = json.loads(case_info.expected_values)
     for key in case_info.expected_keys:
         expected_keys.append('.'.join(key))
     values = []
@@ -83,11 +87,20 @@ def parse_expected(case_info):
 
 class ExcelParser:
 
-    def __init__(self, filename):
+    def __init__(self, filename, read_only=False):
         """
         持有整个 Excel
+
+        read_only 为 True 时以只读模式打开，单元格按行流式读取，不会一次性加载整个工作簿
+        """
+        self.read_only = read_only
+        self.work_book = load_workbook(filename, read_only=read_only)
+
+    def close(self):
+        """
+        关闭 Excel，只读模式下会一直持有文件句柄，需要手动关闭
         """
-        self.work_book = load_workbook(filename)
+        self.work_book.close()
 
     def get_sheet_names(self):
         """
@@ -103,14 +116,20 @@ class ExcelParser:
 
 
 class ExcelWriter:
-    def __init__(self, filename, sheet_name):
+    def __init__(self, filename, sheet_name, write_only=False):
         """
         初始化需要写入的 Excel
+
+        filename 可以是文件路径，也可以是文件对象
+        write_only 为 True 时以只写模式创建，按行追加写入，不在内存中保留单元格
         """
 
-        self.work_book = openpyxl.Workbook()
-        self.sheet = self.work_book.active
-        self.sheet.title = sheet_name
+        self.work_book = openpyxl.Workbook(write_only=write_only)
+        if write_only:
+            self.sheet = self.work_book.create_sheet(sheet_name)
+        else:
+            self.sheet = self.work_book.active
+            self.sheet.title = sheet_name
         self.filename = filename
 
     def write(self, case_infos):
@@ -128,71 +147,97 @@ class ExcelWriter:
     def set_columns(self, case_infos):
         """
         写结果信息
+
+        case_infos 为 QuerySet 时先只查询 id 计算行号，再逐条读取用例，不一次性加载所有用例
         """
 
         # 写表头
         headers = ['description', 'step', 'run', 'method', 'host', 'path', 'sleep', 'params', 'ex_keys', 'ex_values',
                    'headers', 'expected_key', 'expected_value', 'check_step']
-        # 数据长度
-        length = len(headers)
-        for i in range(1, length):
-            self.sheet.cell(row=1, column=i, value=headers[i - 1])
+        self.sheet.append(headers)
+        # 预先计算用例 id 对应的行号，解析依赖时直接取
+        if isinstance(case_infos, QuerySet):
+            ids = case_infos.values_list('id', flat=True)
+            case_infos = case_infos.iterator()
+        else:
+            ids = [case_info.id for case_info in case_infos]
+        rows = {id: index + 1 for index, id in enumerate(ids)}
         # 遍历写所有用例信息
-        for index in range(0, len(case_infos)):
-            row = index + 2
-            case_info = case_infos[index]
-            case_info.row = row - 1
-            self.sheet.cell(row=row, column=1, value=case_info.remark)
-            self.sheet.cell(row=row, column=2, value=case_info.name)
-            self.sheet.cell(row=row, column=3, value='no' if not case_info.run else None)
-            self.sheet.cell(row=row, column=4, value=case_info.method)
-            self.sheet.cell(row=row, column=5, value=case_info.host)
-            self.sheet.cell(row=row, column=6, value=case_info.path)
-            self.sheet.cell(row=row, column=7, value=case_info.delay if case_info.delay > 0 else None)
-            self.sheet.cell(row=row, column=8, value=json.dumps(case_info.params, indent=2,
-                                                                ensure_ascii=False) if case_info.params else None)
-            ex_keys, ex_values = parse_extend(case_info, case_infos)
-            self.sheet.cell(row=row, column=9, value=ex_keys)
-            self.sheet.cell(row=row, column=10, value=ex_values)
-            self.sheet.cell(row=row, column=11, value=case_info.headers)
+        for case_info in case_infos:
+            case_info.row = rows[case_info.id]
+            ex_keys, ex_values = parse_extend(case_info, rows)
             expected_key, expected_value, check_step = parse_expected(case_info)
-            self.sheet.cell(row=row, column=12, value=expected_key)
-            self.sheet.cell(row=row, column=13, value=expected_value)
-            self.sheet.cell(row=row, column=14, value=check_step)
+            self.sheet.append([
+                case_info.remark,
+                case_info.name,
+                'no' if not case_info.run else None,
+                case_info.method,
+                case_info.host,
+                case_info.path,
+                case_info.delay if case_info.delay > 0 else None,
+                json.dumps(case_info.params, indent=2, ensure_ascii=False) if case_info.params else None,
+                ex_keys,
+                ex_values,
+                json.dumps(case_info.headers, ensure_ascii=False) if case_info.headers else None,
+                expected_key,
+                expected_value,
+                check_step
+            ])
 
 
 class CaseInfoHolder:
 
-    def __init__(self, work_book, sheet_name):
+    def __init__(self, work_book, sheet_name, streaming=False):
         """
         解析当前 sheet 页为 CaseInfo 对象列表
 
         :param work_book: 整个工作簿
         :param sheet_name: 当前 sheet 页
+        :param streaming: 是否流式解析，为 True 时 case_infos 为按行生成用例的生成器，只保留表头的五行
         """
         # 取工作簿中对应 sheet 页保存
         self.sheet = work_book[sheet_name]
-        # 获取数据总行数
-        self.rows = list(self.sheet.rows)
+        if streaming:
+            # 按行读取单元格的值
+            self.rows = self.sheet.iter_rows(values_only=True)
+            # 只取出表头的五行
+            self.head = list(islice(self.rows, 5))
+        else:
+            # 获取数据总行数
+            self.rows = list(self.sheet.rows)
+            self.head = None
         # 获取表头列表
-        self.title = [column.value for column in self.rows[4]]
-        # 定义持有的用例列表
-        self.case_infos = []
+        self.title = list(self.head[4]) if streaming else [column.value for column in self.rows[4]]
         # 获取登录行信息
-        self.default_host = self.sheet.cell(row=4, column=2).value
+        self.default_host = self.cell(row=4, column=2)
         # 构建登录信息
         self.login_info = CaseInfo()
         self.build_longin_info()
-        # 构建所有请求信息
-        self.build_request_info()
+        if streaming:
+            # 构建所有请求信息的生成器
+            self.case_infos = self.iter_request_info()
+        else:
+            # 定义持有的用例列表
+            self.case_infos = []
+            # 构建所有请求信息
+            self.build_request_info()
+
+    def cell(self, row, column):
+        """
+        取表头中单元格的值，行列均从 1 开始
+        """
+        if self.head is None:
+            return self.sheet.cell(row=row, column=column).value
+        values = self.head[row - 1] if row - 1 < len(self.head) else ()
+        return values[column - 1] if column - 1 < len(values) else None
 
     def build_longin_info(self):
         """
         构建请求登录的信息
         """
         self.login_info.method = 'post'
-        self.login_info.host = self.sheet.cell(row=2, column=2).value
-        params = self.sheet.cell(row=3, column=2).value
+        self.login_info.host = self.cell(row=2, column=2)
+        params = self.cell(row=3, column=2)
         self.login_info.params = {} if str_is_none(params) else json.loads(params)
         self.login_info.path = ''
         # 请求头为 application/x-www-form-urlencoded
@@ -207,20 +252,60 @@ class CaseInfoHolder:
         for row in range(5, case_count):
             # 获取整行信息为列表
             info = [column.value for column in self.rows[row]]
-            # 定义当前要处理的用例对象
-            case_info = CaseInfo()
-            # 将表头字段对应的列作为对象字段，将当前行对应的列信息作为值，填入用例对象中
-            for i in zip(self.title, info):
-                setattr(case_info, i[0], i[1])
-            # 定义当前用例所在行数(其实该行数为实际对应 Excel 中行数减 1)
-            case_info.row = row
-            # case_info.method = case_info.method.lower()
-            # 如果期望值没填则忽略该数据
-            expected_code = case_info.expected_key
-            if expected_code is None or expected_code == '':
-                continue
+            case_info = self.build_case_info(row, info)
             # 加入用例列表
-            self.case_infos.append(case_info)
+            if case_info:
+                self.case_infos.append(case_info)
+
+    def iter_request_info(self):
+        """
+        按行生成所有用例信息
+        """
+        # 表头的五行已经取出，从第六行开始
+        for row, info in enumerate(self.rows, start=5):
+            case_info = self.build_case_info(row, info)
+            if case_info:
+                yield case_info
+
+    def build_case_info(self, row, info):
+        """
+        将一行信息构建为用例对象，期望值没填时返回 None
+        """
+        # 定义当前要处理的用例对象
+        case_info = CaseInfo()
+        # 将表头字段对应的列作为对象字段，将当前行对应的列信息作为值，填入用例对象中
+        for i, title in enumerate(self.title):
+            if title is None:
+                continue
+            setattr(case_info, title, info[i] if i < len(info) else None)
+        # 定义当前用例所在行数(其实该行数为实际对应 Excel 中行数减 1)
+        case_info.row = row
+        # case_info.method = case_info.method.lower()
+        # 如果期望值没填则忽略该数据
+        expected_code = case_info.expected_key
+        if expected_code is None or expected_code == '':
+            return None
+        return case_info
+
+
+def parse_sheet(filename, sheet_name):
+    """
+    在独立进程中解析单个 sheet 页
+
+    返回每个用例的字段字典，便于跨进程传递，由调用方重新构建用例对象
+    """
+    parser = ExcelParser(filename, read_only=True)
+    try:
+        holder = CaseInfoHolder(parser.work_book, sheet_name, streaming=True)
+        titles = [title for title in holder.title if title is not None]
+        sheet = []
+        for case in holder.case_infos:
+            values = {title: getattr(case, title) for title in titles}
+            values['row'] = case.row
+            sheet.append(values)
+        return sheet
+    finally:
+        parser.close()
 
 
 def str_is_none(source):
@@ -1,10 +1,17 @@
+import base64
+import datetime
+import hashlib
 import json
 
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db.models import Q
 from django.http import QueryDict
 from backend.util.jwt_token import UserHolder
 from backend import LOGGER
 from backend.exception import ErrorCode, PlatformError, ValidateError
+from backend.settings import PAGE_COUNT_TIMEOUT
 
 
 def parse_data(request, method):
@@ -108,6 +115,87 @@ def page_params(data, *args):
     return result
 
 
+def paginate(queryset, data, page, page_size, ordering=None):
+    """
+    分页查询
+
+    请求参数中带有 cursor 时使用游标分页，否则使用原有的页码分页
+    ordering 为游标分页的排序，应与页码分页的排序一致，默认按 updated_at、id 倒序
+    """
+
+    if 'cursor' in data:
+        return CursorPage(queryset, data['cursor'], page_size, ordering)
+    return Paginator(queryset, page_size).page(page)
+
+
+class CursorPage:
+    """
+    基于两个字段的游标分页，默认为 (updated_at, id) 倒序
+
+    1. 以上一页最后一条数据为游标向后查询，不使用 OFFSET，任意深度的分页耗时与第一页一致
+    2. 多查询一条判断是否还有下一页
+    3. 总数从缓存中取，缓存不存在时才 COUNT 一次，因此为近似值
+    4. 第二个字段需要唯一，一般为 id
+    """
+
+    ORDERING = ('-updated_at', '-id')
+
+    def __init__(self, queryset, cursor, page_size, ordering=None):
+        self.page_size = int(page_size)
+        self.ordering = tuple(ordering) if ordering else CursorPage.ORDERING
+        self.total = self.__count(queryset)
+        queryset = queryset.order_by(*self.ordering)
+        if cursor:
+            queryset = queryset.filter(self.__after(queryset.model, CursorPage.decode(cursor)))
+        rows = list(queryset[:self.page_size + 1])
+        self.has_next = len(rows) > self.page_size
+        self.object_list = rows[:self.page_size]
+        self.cursor = self.encode(self.object_list[-1]) if self.has_next else None
+
+    def __after(self, model, values):
+        """
+        排在游标之后的条件
+        """
+
+        if len(values) != len(self.ordering):
+            raise ValidateError.error(ErrorCode.VALIDATION_ERROR, '游标不正确')
+        conditions = []
+        for field, value in zip(self.ordering, values):
+            name = field.lstrip('-')
+            try:
+                value = model._meta.get_field(name).to_python(value)
+            except ValidationError:
+                raise ValidateError.error(ErrorCode.VALIDATION_ERROR, '游标不正确')
+            conditions.append((name, '__lt' if field.startswith('-') else '__gt', value))
+        (first, first_operation, first_value), (second, second_operation, second_value) = conditions
+        return Q(**{first + first_operation: first_value}) | \
+            Q(**{first: first_value, second + second_operation: second_value})
+
+    @staticmethod
+    def __count(queryset):
+        """
+        取缓存的总数
+        """
+
+        key = 'page:count:' + hashlib.md5(str(queryset.query).encode('utf-8')).hexdigest()
+        return cache.get_or_set(key, queryset.count, timeout=PAGE_COUNT_TIMEOUT)
+
+    def encode(self, obj):
+        values = [getattr(obj, field.lstrip('-')) for field in self.ordering]
+        value = json.dumps([o.isoformat() if isinstance(o, datetime.datetime) else o for o in values])
+        return base64.urlsafe_b64encode(value.encode('utf-8')).decode('utf-8')
+
+    @staticmethod
+    def decode(cursor):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')))
+        except (ValueError, TypeError):
+            raise ValidateError.error(ErrorCode.VALIDATION_ERROR, '游标不正确: ' + str(cursor))
+        if not isinstance(values, list):
+            raise ValidateError.error(ErrorCode.VALIDATION_ERROR, '游标不正确: ' + str(cursor))
+        return values
+
+
 def update_fields(obj, always=True, **kwargs):
     """
     更新对象中的属性
@@ -130,10 +218,25 @@ def filter_obj_single(objs, key, value):
     """
     通过对象中的某个 key 过滤列表对象
 
-    只返回一个
+    只返回一个，不存在返回 None
     """
-    obj = [obj for obj in objs if getattr(obj, key) == value]
-    return obj[0]
+    return next((obj for obj in objs if getattr(obj, key) == value), None)
+
+
+def decode_fields(obj, *fields):
+    """
+    将对象中字符串形式的 JSON 字段解析为对象
+
+    兼容字段迁移为 JSONField 之前的数据以及调用方式，已经是对象的值不做处理，解析失败保留原值
+    """
+
+    for field in fields:
+        value = getattr(obj, field, None)
+        if isinstance(value, str):
+            try:
+                setattr(obj, field, json.loads(value))
+            except ValueError:
+                continue
 
 
 def save(entity):
@@ -143,11 +246,21 @@ def save(entity):
     Django 往数据库存储信息
     """
 
+    validate(entity)
+    entity.save()
+
+
+def validate(entity, validate_unique=True):
+    """
+    校验对象信息
+
+    批量校验时可以关闭唯一性校验，由调用方一次查询完成，避免每个对象查询一次
+    """
+
     try:
-        entity.full_clean()
+        entity.full_clean(validate_unique=validate_unique)
     except ValidationError as e:
         raise ValidateError.error(ErrorCode.VALIDATION_ERROR, *e.messages)
-    entity.save()
 
 
 def batch_save(objects, objs):
@@ -0,0 +1,97 @@
+"""
+取值步骤预编译的基准测试
+
+在不同深度的响应文档上对比逐次解析字符串步骤的取值、设值与预编译的 JsonPath
+
+在项目根目录执行: python bench/jsonpath_bench.py [--depths 4 8 16 32] [--times 100000]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'testing_platform.settings')
+
+import django
+
+django.setup()
+
+from backend.util.execute import JsonPath
+
+
+def legacy_get(source, steps):
+    """
+    预编译之前的取值方式，每次调用都解析字符串步骤
+    """
+
+    try:
+        for step in steps:
+            step = step if not step.isdigit() else int(step)
+            if isinstance(step, int) and isinstance(source, list) and len(source) < 1:
+                return None
+            source = source[step]
+    except KeyError:
+        return None
+    return source
+
+
+def legacy_set(value, target, steps):
+    """
+    预编译之前的设值方式，只保留路径均为已有字典、数组时的逻辑
+    """
+
+    for i in range(0, len(steps)):
+        step = steps[i]
+        step = step if not step.isdigit() else int(step)
+        if i == len(steps) - 1:
+            target[step] = value
+        else:
+            target = target[step]
+
+
+def build_document(depth):
+    """
+    生成指定深度的文档，偶数层为字典，奇数层为数组，返回文档以及到最深处的取值步骤
+    """
+
+    document = {'value': 1}
+    steps = ['value']
+    for level in range(depth):
+        if level % 2:
+            document = [None, document]
+            steps.insert(0, '1')
+        else:
+            document = {'key' + str(level): document, 'other': level}
+            steps.insert(0, 'key' + str(level))
+    return document, steps
+
+
+def timed(func, times):
+    start = time.perf_counter()
+    for _ in range(times):
+        func()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='取值步骤预编译的基准测试')
+    parser.add_argument('--depths', type=int, nargs='+', default=[4, 8, 16, 32])
+    parser.add_argument('--times', type=int, default=100000)
+    args = parser.parse_args()
+    print('%6s %12s %12s %8s %12s %12s %8s' % ('depth', 'get old(s)', 'get new(s)', 'speedup',
+                                              'set old(s)', 'set new(s)', 'speedup'))
+    for depth in args.depths:
+        document, steps = build_document(depth)
+        path = JsonPath(steps)
+        assert legacy_get(document, steps) == path.get(document) == 1
+        get_old = timed(lambda: legacy_get(document, steps), args.times)
+        get_new = timed(lambda: path.get(document), args.times)
+        set_old = timed(lambda: legacy_set(2, document, steps), args.times)
+        set_new = timed(lambda: path.set(2, document), args.times)
+        print('%6d %12.4f %12.4f %7.2fx %12.4f %12.4f %7.2fx' % (depth, get_old, get_new, get_old / get_new,
+                                                                 set_old, set_new, set_old / set_new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+用例调度开销的基准测试
+
+在 10、1000、10000 个用例的随机依赖图上执行空的用例函数，输出总耗时以及单个用例的调度开销，
+单个用例的开销应当不随用例数增长
+
+在项目根目录执行: python bench/scheduler_bench.py [--workers 1 8] [--repeat 3]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'testing_platform.settings')
+
+import django
+
+django.setup()
+
+from backend.util.scheduler import CaseScheduler
+
+SIZES = [10, 1000, 10000]
+
+
+def build_cases(size, max_depends=3, seed=0):
+    """
+    生成随机的有向无环图，每个用例只依赖 id 更小的用例
+    """
+
+    rand = random.Random(seed)
+    cases = []
+    for id in range(1, size + 1):
+        count = rand.randint(0, min(max_depends, id - 1))
+        depends = rand.sample(range(1, id), count) if count else []
+        cases.append(SimpleNamespace(id=id, name=str(id), delay=0, run=True, extend_values=None,
+                                     expected_values=[{'depend': depend} for depend in depends]))
+    return cases
+
+
+def bench(size, workers, repeat):
+    """
+    返回多次执行中最快的一次的构建耗时以及调度耗时，单位秒
+    """
+
+    cases = build_cases(size)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        scheduler = CaseScheduler(cases, workers)
+        built = time.perf_counter()
+        scheduler.run(lambda case_info: None)
+        end = time.perf_counter()
+        result = (built - start, end - built)
+        if best is None or sum(result) < sum(best):
+            best = result
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='用例调度开销的基准测试')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    print('%8s %8s %10s %10s %12s' % ('workers', 'cases', 'build(s)', 'run(s)', 'per case(us)'))
+    for workers in args.workers:
+        for size in SIZES:
+            build, run = bench(size, workers, args.repeat)
+            print('%8d %8d %10.4f %10.4f %12.1f' % (workers, size, build, run, (build + run) / size * 1e6))
+
+
+if __name__ == '__main__':
+    main()
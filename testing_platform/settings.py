@@ -50,6 +50,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'backend.middleware.MetricsMiddleware',
     'backend.middleware.RequestMiddleware',
     'backend.middleware.ExceptionMiddleware'
 ]
@@ -104,6 +105,8 @@ CACHES = {
         'OPTIONS': {
             'CONNECTION_POOL_KWARGS': {'max_connections': 100},
             'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            # 统计 Redis 命令次数以及耗时
+            'REDIS_CLIENT_CLASS': 'backend.util.metrics.MetricsRedis',
             'PASSWORD': '',
         },
     },
@@ -238,6 +241,9 @@ LOGGER = logging.getLogger('log')
 
 # 存放文件的路径
 FILE_REPO = os.path.join(os.path.dirname(cur_path), 'files')
+
+# 存放慢请求性能分析结果的路径
+PROFILE_REPO = os.path.join(os.path.dirname(cur_path), 'profiles')
 if not os.path.exists(FILE_REPO):
     # 如果不存在这个文件夹，就自动创建一个
     os.mkdir(FILE_REPO)
@@ -58,6 +58,9 @@ urlpatterns = (
     # 报告
     path('report/', include(report_router.urls)),
 
+    # 请求指标
+    path('', include('backend.handler.metrics.urls')),
+
     url(r'^swagger(?P<format>\.json|\.yaml)$', schema_view.without_ui(cache_timeout=0), name='schema-json'),
     url(r'^swagger/$', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
     url(r'^redoc/$', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc')